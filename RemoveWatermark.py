@@ -1,7 +1,8 @@
 import cv2
-import numpy as np
 import tkinter as tk
 from tkinter import filedialog
+from image_buffer import ImageBuffer
+from inpaint_engine import inpaint_region, rect_mask
 
 def main():
     # File selection dialog
@@ -16,23 +17,23 @@ def main():
     if not file_path:
         return
 
-    # Load image
-    image = cv2.imread(file_path)
-    if image is None:
+    # Load image; this script only hands pixels to OpenCV, so it keeps
+    # OpenCV's BGR order and never converts
+    try:
+        image = ImageBuffer.load(file_path, order="BGR")
+    except ValueError:
         print("Error: Could not load image")
         return
 
     # Select ROI (Region of Interest - watermark area)
-    roi = cv2.selectROI("Select Watermark Area (Drag & Press Enter)", image)
+    roi = cv2.selectROI("Select Watermark Area (Drag & Press Enter)", image.bgr())
     cv2.destroyAllWindows()
 
-    # Create mask
-    mask = np.zeros(image.shape[:2], dtype=np.uint8)
-    x, y, w, h = [int(i) for i in roi]
-    mask[y:y+h, x:x+w] = 255  # Mark selected area for inpainting
+    # Create mask marking the selected area for inpainting
+    mask = rect_mask(image.shape, roi)
 
     # Inpainting using Telea method
-    inpainted_image = cv2.inpaint(image, mask, inpaintRadius=3, flags=cv2.INPAINT_TELEA)
+    inpainted_image = ImageBuffer(inpaint_region(image.pixels, mask, radius=3, engine="telea"), image.order)
 
     # Save output
     output_path = filedialog.asksaveasfilename(
@@ -41,7 +42,7 @@ def main():
         filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg")]
     )
     if output_path:
-        cv2.imwrite(output_path, inpainted_image)
+        inpainted_image.save(output_path)
         print(f"Image saved successfully to {output_path}")
 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import cv2
+
+from image_buffer import ENCODE_DEFAULTS, BatchWriter, ImageBuffer
+from inpaint_cache import InpaintCache
+from inpaint_engine import ENGINES, inpaint_region, rect_mask
+from tiled_image import PNG_FILTERS, PNG_STRATEGIES
+from watermark_detect import DEFAULT_SCALES, detect_mask
+from watermark_estimate import Watermark, estimate_watermark
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# Per-worker state, set once by init_worker so each task only ships a path
+_settings = None
+_masks = {}
+_cache = None
+
+
+def collect_inputs(source):
+    if os.path.isdir(source):
+        paths = [
+            os.path.join(source, name) for name in os.listdir(source)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    else:
+        paths = glob.glob(source)
+    return sorted(p for p in paths if os.path.isfile(p))
+
+
+def output_names(paths):
+    # Each input's path below the deepest directory holding them all, so
+    # inputs from different directories keep distinct output names
+    if not paths:
+        return []
+    paths = [os.path.abspath(p) for p in paths]
+    base = os.path.commonpath([os.path.dirname(p) for p in paths])
+    return [os.path.relpath(p, base) for p in paths]
+
+
+def load_mask(path):
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"Could not load mask {path}")
+    mask[mask > 0] = 255
+    return mask
+
+
+def parse_scales(text):
+    try:
+        scales = tuple(float(v) for v in text.split(","))
+    except ValueError:
+        scales = ()
+    if not scales or min(scales) <= 0:
+        raise argparse.ArgumentTypeError("scales must be positive numbers like 0.9,1,1.1")
+    return scales
+
+
+def parse_roi(text):
+    try:
+        roi = [int(v) for v in text.split(",")]
+    except ValueError:
+        roi = []
+    if len(roi) != 4:
+        raise argparse.ArgumentTypeError("ROI must be x,y,w,h")
+    return tuple(roi)
+
+
+def init_worker(settings):
+    global _settings, _cache
+    # Parallelism comes from the pool; keep OpenCV from oversubscribing cores
+    cv2.setNumThreads(1)
+    _settings = settings
+    _masks.clear()
+    _cache = None
+    if settings["cache_mb"] > 0 or settings["cache_dir"]:
+        # Workers share the on-disk tier, so a repeat run is all lookups
+        _cache = InpaintCache(settings["cache_mb"] * 2 ** 20, settings["cache_dir"])
+
+
+def mask_for(shape):
+    key = shape[:2]
+    mask = _masks.get(key)
+    if mask is None:
+        if _settings["mask"] is not None:
+            mask = _settings["mask"]
+            if mask.shape[:2] != key:
+                raise ValueError(f"mask is {mask.shape[1]}x{mask.shape[0]}, image is {key[1]}x{key[0]}")
+        else:
+            mask = rect_mask(shape, _settings["roi"])
+        _masks[key] = mask
+    return mask
+
+
+def locate_mask(image):
+    mask, _, score = detect_mask(image, _settings["template"], _settings["threshold"], _settings["scales"])
+    if mask is None:
+        raise ValueError(f"watermark not found (best match {score:.2f})")
+    return mask
+
+
+def process_batch(jobs):
+    # Image N is encoded and written on a background thread while image
+    # N+1 is inpainted. jobs are (input path, output name) pairs. Returns
+    # (path, error, encode seconds, bytes) for each image and the batch's
+    # cache statistics.
+    writer = BatchWriter(_settings["encode"])
+    engine = _settings["engine"] if _cache is None else _cache.engine(_settings["engine"])
+    failed = []
+    for path, name in jobs:
+        try:
+            image = cv2.imread(path)
+            if image is None:
+                raise ValueError("Could not load image")
+            if _settings["watermark"] is not None:
+                # Reverse alpha blend: one pass, no inpainting
+                result = _settings["watermark"].remove(image)
+            else:
+                if _settings["template"] is not None:
+                    mask = locate_mask(image)
+                else:
+                    mask = mask_for(image.shape)
+                result = inpaint_region(image, mask, _settings["radius"], engine)
+            output_path = os.path.join(_settings["output"], name)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            writer.write(path, ImageBuffer(result, "BGR"), output_path)
+        except Exception as e:
+            failed.append((path, str(e), 0.0, 0))
+    return failed + writer.close(), _cache.take_stats() if _cache is not None else {}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Remove a watermark at a fixed position from many images.")
+    parser.add_argument("input", help="input directory or glob pattern")
+    parser.add_argument("-o", "--output", required=True, help="output directory")
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument("--roi", type=parse_roi, help="watermark rectangle as x,y,w,h")
+    region.add_argument("--mask", help="mask image; non-zero pixels are inpainted")
+    region.add_argument("--template", help="reference crop of the watermark to locate in every image")
+    region.add_argument("--watermark", help="watermark estimated by watermark_estimate.py; "
+                                            "removed by reversing its alpha blend")
+    parser.add_argument("--unblend", action="store_true",
+                        help="estimate the semi-transparent watermark inside --roi/--mask from all "
+                             "inputs, then remove it by reversing its alpha blend instead of inpainting")
+    parser.add_argument("--threshold", type=float, default=0.7,
+                        help="minimum match score for --template (default: %(default)s)")
+    parser.add_argument("--scales", type=parse_scales, default=DEFAULT_SCALES,
+                        help="template scales to search, comma separated")
+    parser.add_argument("--algorithm", choices=sorted(ENGINES), default="telea")
+    parser.add_argument("--radius", type=float, default=3)
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--cache-mb", type=int, default=64,
+                        help="in-memory inpaint result cache per worker, 0 to disable (default: %(default)s)")
+    parser.add_argument("--cache-dir", help="also keep inpaint results in this directory, across runs")
+    encode = parser.add_argument_group("output encoding")
+    encode.add_argument("--png-compression", type=int, choices=range(10), metavar="0-9",
+                        default=ENCODE_DEFAULTS["png"]["compression"])
+    encode.add_argument("--png-strategy", choices=sorted(PNG_STRATEGIES), default=ENCODE_DEFAULTS["png"]["strategy"])
+    encode.add_argument("--png-filter", choices=sorted(PNG_FILTERS), default=ENCODE_DEFAULTS["png"]["filter"])
+    encode.add_argument("--jpeg-quality", type=int, default=ENCODE_DEFAULTS["jpeg"]["quality"])
+    encode.add_argument("--jpeg-optimize", action="store_true", help="optimise Huffman tables (smaller, slower)")
+    encode.add_argument("--jpeg-progressive", action="store_true")
+    encode.add_argument("--webp-quality", type=int, default=ENCODE_DEFAULTS["webp"]["quality"])
+    encode.add_argument("--webp-method", type=int, choices=range(7), metavar="0-6",
+                        default=ENCODE_DEFAULTS["webp"]["method"], help="0 is fastest, 6 smallest")
+    encode.add_argument("--webp-lossless", action="store_true")
+    return parser
+
+
+def encode_settings(args):
+    return {
+        "png": {"compression": args.png_compression, "strategy": args.png_strategy, "filter": args.png_filter},
+        "jpeg": {"quality": args.jpeg_quality, "optimize": args.jpeg_optimize,
+                 "progressive": args.jpeg_progressive},
+        "webp": {"quality": args.webp_quality, "method": args.webp_method, "lossless": args.webp_lossless},
+    }
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    paths = collect_inputs(args.input)
+    if not paths:
+        print("Error: No input images found")
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+    output_dir = os.path.realpath(args.output)
+    if any(os.path.dirname(os.path.realpath(p)) == output_dir for p in paths):
+        print("Error: Output directory must differ from the input directory")
+        return 1
+
+    template = None
+    if args.template:
+        template = cv2.imread(args.template, cv2.IMREAD_GRAYSCALE)
+        if template is None:
+            print(f"Error: Could not load template {args.template}")
+            return 1
+
+    watermark = None
+    if args.watermark:
+        try:
+            watermark = Watermark.load(args.watermark)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: Could not load watermark {args.watermark}: {e}")
+            return 1
+    elif args.unblend:
+        if args.template:
+            print("Error: --unblend needs a fixed --roi or --mask")
+            return 1
+        first = cv2.imread(paths[0])
+        if first is None:
+            print(f"Error: Could not load {paths[0]}")
+            return 1
+        start = time.perf_counter()
+        try:
+            region = load_mask(args.mask) if args.mask else rect_mask(first.shape, args.roi)
+            watermark = estimate_watermark(paths, region)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return 1
+        print(f"Estimated the watermark from {len(paths)} images in {time.perf_counter() - start:.2f}s")
+
+    settings = {
+        "mask": load_mask(args.mask) if args.mask else None,
+        "roi": args.roi,
+        "template": template,
+        "watermark": watermark,
+        "threshold": args.threshold,
+        "scales": args.scales,
+        "radius": args.radius,
+        "engine": args.algorithm,
+        "encode": encode_settings(args),
+        "output": output_dir,
+        "cache_mb": args.cache_mb,
+        "cache_dir": args.cache_dir,
+    }
+
+    failed = 0
+    encode_time = 0.0
+    written = 0
+    cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+    start = time.perf_counter()
+    workers = max(1, min(args.workers or 1, len(paths)))
+    # Batches of a few images give each worker something to inpaint while
+    # the previous image encodes, without leaving workers idle at the end
+    size = max(1, min(len(paths) // workers, max(2, len(paths) // (workers * 4))))
+    # Outputs mirror the inputs' paths below their common directory, so
+    # inputs from different directories never overwrite each other
+    jobs = list(zip(paths, output_names(paths)))
+    batches = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+    with Pool(workers, initializer=init_worker, initargs=(settings,)) as pool:
+        for results, stats in pool.imap_unordered(process_batch, batches):
+            for name, count in stats.items():
+                cache_stats[name] += count
+            for path, error, seconds, nbytes in results:
+                encode_time += seconds
+                written += nbytes
+                if error is not None:
+                    failed += 1
+                    print(f"Error: {path}: {error}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    done = len(paths) - failed
+    print(f"Processed {done} of {len(paths)} images in {elapsed:.2f}s "
+          f"({done / elapsed:.1f} images/s, {workers} workers)")
+    print(f"Encoded {written / 2 ** 20:.1f} MB in {encode_time:.2f}s of worker time")
+    if cache_stats["hits"] or cache_stats["misses"]:
+        print(f"Inpaint cache: {cache_stats['hits']} hits ({cache_stats['disk_hits']} from disk), "
+              f"{cache_stats['misses']} misses")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
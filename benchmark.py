@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from inpaint_engine import ENGINES, inpaint_region
+
+MASK_KINDS = ("logo", "banner", "text", "tiles")
+DISPLAY_SIZE = (1200, 800)
+
+# Timings that moved by less than this are noise, whatever the ratio
+MIN_DELTA = 0.002
+
+
+def parse_list(value, kind=str):
+    return [kind(v) for v in value.split(",") if v.strip()]
+
+
+def synthetic_image(megapixels, channels, seed=0):
+    # Ground truth with smooth shading and fine texture, built band by band
+    # so 100 MP images don't need float copies of the whole frame
+    w = int(np.sqrt(megapixels * 1e6 * 4 / 3))
+    h = int(w * 3 / 4)
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (max(2, h // 16), max(2, w // 16), 3), dtype=np.uint8)
+    texture = rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    texture = cv2.GaussianBlur(texture, (0, 0), 1.5, borderType=cv2.BORDER_WRAP)
+    image = cv2.resize(coarse, (w, h), interpolation=cv2.INTER_LINEAR)
+    stripes = 40 * np.sin(np.arange(w, dtype=np.float32) / 7.0)[None, :, None]
+    for y0 in range(0, h, 1024):
+        y1 = min(h, y0 + 1024)
+        tile = np.tile(texture, (-(-(y1 - y0) // 256) + 1, -(-w // 256), 1))
+        tile = tile[y0 % 256:y0 % 256 + (y1 - y0), :w]
+        mixed = image[y0:y1] * np.float32(0.6) + tile * np.float32(0.4) + stripes
+        image[y0:y1] = np.clip(mixed, 0, 255)
+    if channels == 1:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def make_mask(kind, shape, seed=0):
+    h, w = shape[:2]
+    mask = np.zeros((h, w), dtype=np.uint8)
+    rng = np.random.default_rng(seed)
+    side = min(h, w)
+    if kind == "logo":
+        # Emblem with a caption in the bottom-right corner
+        cx, cy, r = w - side // 8, h - side // 8, side // 20
+        cv2.circle(mask, (cx, cy), r, 255, -1)
+        cv2.putText(mask, "LOGO", (cx - 4 * r, cy + 2 * r), cv2.FONT_HERSHEY_SIMPLEX,
+                    r / 25, 255, max(1, r // 8))
+    elif kind == "banner":
+        bh = max(4, h // 25)
+        mask[h - 3 * bh:h - 2 * bh, :] = 255
+    elif kind == "text":
+        scale = side / 600
+        for _ in range(12):
+            x, y = int(rng.integers(0, w * 3 // 4)), int(rng.integers(side // 20, h))
+            cv2.putText(mask, "sample", (x, y), cv2.FONT_HERSHEY_SIMPLEX, scale, 255, max(1, int(2 * scale)))
+    elif kind == "tiles":
+        # Stock-photo style text repeated over the whole frame
+        step = max(64, side // 5)
+        scale = step / 200
+        for y in range(step // 2, h, step):
+            for x in range(-step // 2 if (y // step) % 2 else 0, w, step):
+                cv2.putText(mask, "PREVIEW", (x, y), cv2.FONT_HERSHEY_SIMPLEX, scale, 255, max(1, int(3 * scale)))
+    else:
+        raise ValueError(f"Unknown mask kind: {kind}")
+    return mask
+
+
+def watermark(image, mask, alpha=0.6):
+    # White overlay at `alpha` wherever the mask is set
+    marked = image.copy()
+    hole = mask > 0
+    marked[hole] = (image[hole] * (1 - alpha) + 255 * alpha).astype(np.uint8)
+    return marked
+
+
+def psnr(result, truth, mask=None):
+    if mask is not None:
+        hole = mask > 0
+        result, truth = result[hole], truth[hole]
+    diff = result.astype(np.float64) - truth
+    mse = float(np.mean(diff * diff))
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def timed(fn, repeat):
+    # Best wall time over `repeat` runs, then the peak of Python/NumPy memory
+    # allocated during one more run (native OpenCV scratch buffers aren't
+    # traced). Tracing slows every allocation, so it is off while timing.
+    best = None
+    result = None
+    for _ in range(repeat):
+        # Let the previous run's output go before measuring the next one
+        result = None
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = None
+    tracemalloc.start()
+    try:
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def open_display():
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+        root.withdraw()
+        return root
+    except Exception:
+        return None
+
+
+def fit_display(image, size=DISPLAY_SIZE):
+    h, w = image.shape[:2]
+    ratio = min(size[0] / w, size[1] / h)
+    return max(1, int(w * ratio)), max(1, int(h * ratio))
+
+
+def bench_image(megapixels, channels, args, display, log):
+    truth = synthetic_image(megapixels, channels)
+    label = f"{megapixels:g}MP-{'grey' if channels == 1 else 'rgb'}"
+    h, w = truth.shape[:2]
+    results = {}
+
+    def record(stage, seconds, peak, **extra):
+        key = f"{label}/{stage}"
+        results[key] = dict(seconds=seconds, peak_bytes=peak, width=w, height=h, **extra)
+        log(key, results[key])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext in ("png", "jpg"):
+            path = os.path.join(tmp, "image." + ext)
+            cv2.imwrite(path, truth)
+            seconds, peak, loaded = timed(lambda: cv2.imread(path, cv2.IMREAD_UNCHANGED), args.repeat)
+            record(f"imread-{ext}", seconds, peak)
+            del loaded
+
+    code = cv2.COLOR_GRAY2RGB if channels == 1 else cv2.COLOR_BGR2RGB
+    seconds, peak, rgb = timed(lambda: cv2.cvtColor(truth, code), args.repeat)
+    record("cvtColor", seconds, peak)
+
+    pil = Image.fromarray(rgb)
+    size = fit_display(rgb)
+    seconds, peak, shown = timed(lambda: pil.resize(size, Image.LANCZOS), args.repeat)
+    record("resize-lanczos", seconds, peak)
+    del rgb, pil
+
+    if display is not None:
+        from PIL import ImageTk
+        seconds, peak, _ = timed(lambda: ImageTk.PhotoImage(shown, master=display), args.repeat)
+        record("photoimage", seconds, peak)
+
+    for kind in args.masks:
+        mask = make_mask(kind, truth.shape)
+        marked = watermark(truth, mask)
+        coverage = cv2.countNonZero(mask) / mask.size
+        for engine in args.engines:
+            for radius in args.radii:
+                seconds, peak, result = timed(lambda: inpaint_region(marked, mask, radius, engine), args.repeat)
+                record(f"inpaint-{engine}-r{radius:g}-{kind}", seconds, peak,
+                       psnr=round(psnr(result, truth, mask), 3), coverage=round(coverage, 5))
+    return results
+
+
+def compare(results, baseline, threshold, psnr_drop):
+    # Stages slower than baseline by more than `threshold` (a fraction), or
+    # whose PSNR fell by more than `psnr_drop` dB
+    regressions = []
+    for key, now in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if now["seconds"] > before["seconds"] * (1 + threshold) and now["seconds"] - before["seconds"] > MIN_DELTA:
+            regressions.append(f"{key}: {before['seconds']:.4f}s -> {now['seconds']:.4f}s "
+                               f"(+{now['seconds'] / before['seconds'] - 1:.0%})")
+        if "psnr" in now and "psnr" in before and now["psnr"] < before["psnr"] - psnr_drop:
+            regressions.append(f"{key}: PSNR {before['psnr']:.2f} -> {now['psnr']:.2f} dB")
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the loading, inpainting and display stages.")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--sizes", type=lambda v: parse_list(v, float), default=[1, 4, 16],
+                        help="image sizes in megapixels, comma separated (default: 1,4,16)")
+    parser.add_argument("--channels", type=lambda v: parse_list(v, int), default=[1, 3],
+                        help="1 for grey, 3 for colour (default: 1,3)")
+    parser.add_argument("--masks", type=parse_list, default=list(MASK_KINDS),
+                        help="mask kinds: " + ",".join(MASK_KINDS))
+    parser.add_argument("--engines", type=parse_list, default=["telea", "ns"],
+                        help="engines to time: " + ",".join(sorted(ENGINES)))
+    parser.add_argument("--radii", type=lambda v: parse_list(v, float), default=[3, 7])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage; the best is kept")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed slowdown against the baseline (default: %(default)s)")
+    parser.add_argument("--psnr-drop", type=float, default=0.5,
+                        help="allowed PSNR loss in dB against the baseline (default: %(default)s)")
+    parser.add_argument("--no-display", action="store_true", help="skip the PhotoImage stage")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    for kind in args.masks:
+        if kind not in MASK_KINDS:
+            print(f"Error: Unknown mask kind {kind}")
+            return 1
+    for engine in args.engines:
+        if engine not in ENGINES:
+            print(f"Error: Unknown engine {engine}")
+            return 1
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    display = None if args.no_display else open_display()
+    if display is None and not args.no_display:
+        print("No display available; skipping the PhotoImage stage")
+
+    def log(key, entry):
+        extra = f"  PSNR {entry['psnr']:.2f} dB" if "psnr" in entry else ""
+        print(f"{key:<48} {entry['seconds'] * 1000:10.2f} ms  {entry['peak_bytes'] / 2 ** 20:8.1f} MB{extra}")
+
+    results = {}
+    for megapixels in args.sizes:
+        for channels in args.channels:
+            results.update(bench_image(megapixels, channels, args, display, log))
+
+    if args.output:
+        report = {
+            "meta": {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "opencv": cv2.__version__,
+                "numpy": np.__version__,
+                "args": vars(args),
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold, args.psnr_drop)
+        for line in regressions:
+            print(f"Regression: {line}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
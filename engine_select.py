@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from inpaint_engine import ENGINES, inpaint_region, mask_bbox
+
+PROFILE_PATH = os.path.join(os.path.expanduser("~"), ".watermark_remover", "engine_profile.json")
+
+# An engine meets the quality goal when its predicted error is within this
+# fraction of the best engine's, or within ERROR_SLACK grey levels of it
+QUALITY_TOLERANCE = 0.25
+ERROR_SLACK = 2.0
+
+# Engines predicted to take longer than this are only used when every
+# engine is
+TIME_BUDGET = 10.0
+
+# RMSE of an 8-bit image can't exceed this
+MAX_ERROR = 255.0
+
+# Masks are measured on a copy scaled down to about this many pixels
+FEATURE_MAX_PIXELS = 4 * 1024 * 1024
+
+# Coefficients measured on a reference machine, used until this machine has
+# been calibrated. "time" weighs time_terms() in seconds, "error" weighs
+# error_terms() in RMSE grey levels. "range" is the thickest mask measured;
+# error is not extrapolated past it.
+DEFAULT_PROFILE = {
+    "machine": None,
+    "range": {"thickness": 28.0},
+    "engines": {
+        "telea": {"time": [1.1e-3, 0.0, 1.3e-7, 0.0, 1.8e-8], "error": [7.0, 1.1]},
+        "ns": {"time": [7.5e-4, 0.0, 1.3e-7, 0.0, 1.1e-8], "error": [4.7, 0.98]},
+        "patchmatch": {"time": [0.0, 1.3e-4, 0.0, 0.0, 1.2e-7], "error": [11.2, 0.2]},
+    },
+}
+
+
+def machine_id():
+    return {
+        "node": platform.node(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def mask_features(mask, radius):
+    # area: masked pixels; components: separate blobs; bbox: bounding box
+    # area; thickness: widest part of the mask, i.e. how far an engine has
+    # to reach in from the known pixels
+    bbox = mask_bbox(mask)
+    if bbox is None:
+        return None
+    x0, y0, x1, y1 = bbox
+    crop = np.ascontiguousarray(mask[y0:y1, x0:x1])
+    scale = min(1.0, np.sqrt(FEATURE_MAX_PIXELS / crop.size))
+    if scale < 1.0:
+        size = (max(1, int(crop.shape[1] * scale)), max(1, int(crop.shape[0] * scale)))
+        crop = cv2.resize(crop, size, interpolation=cv2.INTER_NEAREST)
+    crop = (crop > 0).astype(np.uint8)
+    components = cv2.connectedComponents(crop, connectivity=8)[0] - 1
+    padded = cv2.copyMakeBorder(crop, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    thickness = 2 * float(cv2.distanceTransform(padded, cv2.DIST_L2, 3).max())
+    return {
+        "area": cv2.countNonZero(crop) / (scale * scale),
+        "components": components,
+        "bbox": float((x1 - x0) * (y1 - y0)),
+        "thickness": thickness / scale,
+        "radius": float(radius),
+    }
+
+
+def time_terms(f):
+    # Diffusion engines visit every masked pixel and look radius^2 pixels
+    # around it; everything scales with the area and the window around it
+    return [1.0, f["area"], f["area"] * f["radius"] ** 2, f["components"], f["bbox"]]
+
+
+def error_terms(f):
+    return [1.0, f["thickness"]]
+
+
+def load_profile(path=PROFILE_PATH):
+    # None unless the file exists and was calibrated on this machine
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if profile.get("machine") != machine_id() or "range" not in profile:
+        return None
+    return profile
+
+
+def save_profile(profile, path=PROFILE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp, path)
+
+
+def calibration_image(shape=(384, 512)):
+    # Texture with both smooth shading and fine detail, so diffusion and
+    # patch-based engines score differently
+    rng = np.random.default_rng(0)
+    h, w = shape
+    noise = cv2.GaussianBlur(rng.integers(0, 256, (h, w, 3)).astype(np.float32), (0, 0), 2)
+    yy, xx = np.mgrid[0:h, 0:w]
+    stripes = 60 * np.sin(xx / 5.0 + yy / 9.0)[..., None]
+    shading = (xx / w * 80)[..., None]
+    return np.clip(noise + stripes + shading, 0, 255).astype(np.uint8)
+
+
+def calibration_cases(shape):
+    # Thin strokes up to banner-like bars; thicker masks than these get the
+    # error predicted for the thickest
+    h, w = shape
+    for thickness in (4, 16, 56):
+        for length in (48, 128):
+            for components in (1, 3):
+                for radius in (3, 9):
+                    mask = np.zeros(shape, np.uint8)
+                    for i in range(components):
+                        x = 40 + i * (w - 80 - length) // 2
+                        y = 40 + i * (h - 80 - thickness) // 2
+                        mask[y:y + thickness, x:x + length] = 255
+                    yield mask, radius
+
+
+def fit(rows, values):
+    # Least squares with non-negative coefficients: terms that come out
+    # negative are dropped one at a time, so a model never predicts less
+    # work for a bigger mask
+    rows, values = np.asarray(rows), np.asarray(values)
+    active = list(range(rows.shape[1]))
+    coef = np.zeros(rows.shape[1])
+    while active:
+        solution = np.linalg.lstsq(rows[:, active], values, rcond=None)[0]
+        if solution.min() >= 0:
+            coef[active] = solution
+            break
+        del active[int(np.argmin(solution))]
+    return coef.tolist()
+
+
+def measure(engine, image, mask, radius):
+    # Best of a few runs for fast engines; slow ones are timed once
+    best = None
+    spent = 0.0
+    for _ in range(3):
+        start = time.perf_counter()
+        result = inpaint_region(image, mask, radius, engine)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        spent += elapsed
+        if spent > 0.2:
+            break
+    hole = mask > 0
+    diff = result[hole].astype(np.float64) - image[hole]
+    return best, float(np.sqrt(np.mean(diff * diff)))
+
+
+def calibrate(engines=None, progress=None):
+    # Times every engine on synthetic masks and fits the per-engine linear
+    # models used by EngineSelector
+    names = sorted(ENGINES) if engines is None else list(engines)
+    image = calibration_image()
+    cases = list(calibration_cases(image.shape[:2]))
+    thickness = max(mask_features(mask, radius)["thickness"] for mask, radius in cases)
+    profile = {"machine": machine_id(), "range": {"thickness": thickness}, "engines": {}}
+    for name in names:
+        times, errors, t_rows, e_rows = [], [], [], []
+        for mask, radius in cases:
+            f = mask_features(mask, radius)
+            seconds, error = measure(name, image, mask, radius)
+            times.append(seconds)
+            errors.append(error)
+            t_rows.append(time_terms(f))
+            e_rows.append(error_terms(f))
+        profile["engines"][name] = {"time": fit(t_rows, times), "error": fit(e_rows, errors)}
+        if progress is not None:
+            progress(name)
+    return profile
+
+
+class EngineSelector:
+    # Picks the fastest engine whose predicted quality is close enough to
+    # the best available one, from a per-machine calibration profile
+    def __init__(self, path=PROFILE_PATH, tolerance=QUALITY_TOLERANCE, time_budget=TIME_BUDGET):
+        self.path = path
+        self.tolerance = tolerance
+        self.time_budget = time_budget
+        profile = load_profile(path)
+        self.calibrated = profile is not None
+        self.profile = profile or DEFAULT_PROFILE
+
+    def calibrate(self):
+        profile = calibrate()
+        self.profile = profile
+        self.calibrated = True
+        save_profile(profile, self.path)
+
+    def estimate(self, mask, radius):
+        # {name: (seconds, rmse)} for every registered, profiled engine
+        f = mask_features(mask, radius)
+        if f is None:
+            return {}
+        t = time_terms(f)
+        e = error_terms(dict(f, thickness=min(f["thickness"], self.profile["range"]["thickness"])))
+        estimates = {}
+        for name, model in self.profile["engines"].items():
+            if name not in ENGINES:
+                continue
+            seconds = max(0.0, float(np.dot(model["time"], t)))
+            error = min(MAX_ERROR, max(0.0, float(np.dot(model["error"], e))))
+            estimates[name] = (seconds, error)
+        return estimates
+
+    def choose(self, mask, radius, default="telea"):
+        estimates = self.estimate(mask, radius)
+        if not estimates:
+            return default
+        best = min(error for _, error in estimates.values())
+        goal = max(best * (1 + self.tolerance), best + ERROR_SLACK)
+        good = [(seconds, name) for name, (seconds, error) in estimates.items() if error <= goal]
+        if min(good)[0] <= self.time_budget:
+            return min(good)[1]
+        # Nothing good enough is fast enough: the most accurate engine that
+        # is, or the fastest good one if every engine is over budget
+        fast = [(error, name) for name, (seconds, error) in estimates.items() if seconds <= self.time_budget]
+        if fast:
+            return min(fast)[1]
+        return min(good)[1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calibrate automatic inpainting engine selection.")
+    parser.add_argument("--profile", default=PROFILE_PATH, help="profile file (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    profile = calibrate(progress=lambda name: print(f"Calibrated {name}"))
+    save_profile(profile, args.profile)
+    print(f"Wrote {args.profile} in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
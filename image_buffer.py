@@ -0,0 +1,203 @@
+import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from tiled_image import PNG_STRATEGIES, write_png
+
+# Speed-versus-size settings per output format. PNG: zlib level 0-9, zlib
+# strategy and the scanline filter (the defaults are OpenCV's own, its
+# fastest); JPEG: quality 0-100, Huffman optimisation, progressive scans;
+# WebP: quality 0-100, method 0 (fast) to 6 (small), lossless.
+ENCODE_DEFAULTS = {
+    "png": {"compression": 1, "strategy": "rle", "filter": "sub"},
+    "jpeg": {"quality": 95, "optimize": False, "progressive": False},
+    "webp": {"quality": 90, "method": 4, "lossless": False},
+}
+
+FORMATS = {".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg", ".webp": "webp"}
+
+
+def encode_options(path, options=None):
+    # (format, settings) for path: the defaults for its format overridden by
+    # options[format]; format is None for extensions left to OpenCV
+    fmt = FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        return None, {}
+    settings = dict(ENCODE_DEFAULTS[fmt])
+    if options and fmt in options:
+        settings.update(options[fmt])
+    return fmt, settings
+
+
+def png_params(settings):
+    # cv2.imwrite/imencode parameters. OpenCV builds without the scanline
+    # filter parameter pick the filter themselves.
+    params = [
+        int(cv2.IMWRITE_PNG_COMPRESSION), int(settings["compression"]),
+        int(cv2.IMWRITE_PNG_STRATEGY), PNG_STRATEGIES[settings["strategy"]],
+    ]
+    if hasattr(cv2, "IMWRITE_PNG_FILTER"):
+        flag = getattr(cv2, "IMWRITE_PNG_FILTER_" + settings["filter"].upper())
+        params += [int(cv2.IMWRITE_PNG_FILTER), int(flag)]
+    return params
+
+
+def jpeg_params(settings):
+    return [
+        int(cv2.IMWRITE_JPEG_QUALITY), int(settings["quality"]),
+        int(cv2.IMWRITE_JPEG_OPTIMIZE), int(bool(settings["optimize"])),
+        int(cv2.IMWRITE_JPEG_PROGRESSIVE), int(bool(settings["progressive"])),
+    ]
+
+
+class ImageBuffer:
+    # An 8-bit, 3-channel image kept in one canonical channel order: "RGB"
+    # in the GUIs, where PIL and Tk want it, or "BGR" where only OpenCV
+    # touches the pixels. Inpainting works on either order unchanged, so the
+    # full frame is only converted where an API insists on the other one,
+    # and display images are made from the display-sized pixels.
+    def __init__(self, pixels, order="RGB"):
+        if order not in ("RGB", "BGR"):
+            raise ValueError(f"Unknown channel order: {order}")
+        self.pixels = pixels
+        self.order = order
+
+    @classmethod
+    def load(cls, path, order="RGB", flags=cv2.IMREAD_COLOR):
+        # IMREAD_COLOR (and the IMREAD_REDUCED_COLOR_* modes) decode grey and
+        # alpha images straight to 3 channels; the swap to RGB is in place
+        img = cv2.imread(path, flags)
+        if img is None:
+            raise ValueError("Unsupported image format")
+        if order == "RGB":
+            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+        return cls(img, order)
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+    def rgb(self):
+        if self.order == "RGB":
+            return self.pixels
+        return cv2.cvtColor(self.pixels, cv2.COLOR_BGR2RGB)
+
+    def bgr(self):
+        if self.order == "BGR":
+            return self.pixels
+        return cv2.cvtColor(self.pixels, cv2.COLOR_RGB2BGR)
+
+    def resized(self, size):
+        # The pixels scaled to size (w, h), or the buffer itself if it
+        # already is that size
+        h, w = self.pixels.shape[:2]
+        if size is None or tuple(size) == (w, h):
+            return self.pixels
+        shrinking = size[0] * size[1] < w * h
+        return cv2.resize(self.pixels, tuple(size),
+                          interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+    def pil(self, size=None):
+        view = self.resized(size)
+        if self.order == "BGR":
+            view = cv2.cvtColor(view, cv2.COLOR_BGR2RGB)
+        return Image.fromarray(view)
+
+    def photo(self, size=None, reuse=None, mask=None, mask_color=(255, 0, 0)):
+        # Tk image of the buffer at size, with mask (full resolution) shown
+        # in mask_color (RGB). If reuse is a PhotoImage of the same size it
+        # is updated in place and returned, so canvas items keep showing it.
+        from PIL import ImageTk
+        view = self.resized(size)
+        if mask is not None:
+            if view is self.pixels:
+                view = view.copy()
+            shown = cv2.resize(mask, (view.shape[1], view.shape[0]), interpolation=cv2.INTER_NEAREST)
+            color = mask_color if self.order == "RGB" else mask_color[::-1]
+            view[shown == 255] = color
+        img = ImageBuffer(view, self.order).pil()
+        if reuse is not None and (reuse.width(), reuse.height()) == img.size:
+            reuse.paste(img)
+            return reuse
+        return ImageTk.PhotoImage(img)
+
+    def save(self, path, options=None):
+        # Encodes to path with ENCODE_DEFAULTS overridden by options (same
+        # layout) and returns (seconds, bytes written)
+        start = time.perf_counter()
+        fmt, settings = encode_options(path, options)
+        if fmt == "png" and isinstance(self.pixels, np.memmap):
+            # Memory-mapped frames are streamed band by band in either
+            # order, so neither they nor a converted copy need to be in RAM
+            write_png(path, self.pixels, level=settings["compression"], filter=settings["filter"],
+                      bgr=self.order == "BGR", strategy=settings["strategy"])
+        elif fmt == "webp":
+            # OpenCV has no WebP method setting
+            self.pil().save(path, "WEBP", quality=settings["quality"], method=settings["method"],
+                            lossless=settings["lossless"])
+        else:
+            params = []
+            if fmt == "png":
+                params = png_params(settings)
+            elif fmt == "jpeg":
+                params = jpeg_params(settings)
+            if not cv2.imwrite(path, self.bgr(), params):
+                raise ValueError(f"Could not write {path}")
+        return time.perf_counter() - start, os.path.getsize(path)
+
+    def encode(self, ext, options=None):
+        # The image encoded in memory for an extension such as ".png", with
+        # the same settings as save()
+        fmt, settings = encode_options(ext, options)
+        if fmt == "webp":
+            out = io.BytesIO()
+            self.pil().save(out, "WEBP", quality=settings["quality"], method=settings["method"],
+                            lossless=settings["lossless"])
+            return out.getvalue()
+        params = []
+        if fmt == "png":
+            params = png_params(settings)
+        elif fmt == "jpeg":
+            params = jpeg_params(settings)
+        ok, data = cv2.imencode(ext, self.bgr(), params)
+        if not ok:
+            raise ValueError(f"Could not encode {ext}")
+        return data.tobytes()
+
+
+class BatchWriter:
+    # Encodes and writes images on a background thread so the caller can
+    # get on with the next image. At most max_pending images wait to be
+    # written, which bounds memory; close() waits for the rest.
+    def __init__(self, options=None, max_pending=2):
+        self.options = options
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+        self.results = []
+
+    def write(self, key, buffer, path):
+        while len(self.pending) >= self.max_pending:
+            self.collect(self.pending.popleft())
+        self.pending.append((key, self.executor.submit(buffer.save, path, self.options)))
+
+    def collect(self, job):
+        key, future = job
+        try:
+            seconds, size = future.result()
+            self.results.append((key, None, seconds, size))
+        except Exception as e:
+            self.results.append((key, str(e), 0.0, 0))
+
+    def close(self):
+        # [(key, error, encode seconds, bytes)] for every image written
+        while self.pending:
+            self.collect(self.pending.popleft())
+        self.executor.shutdown()
+        return self.results
@@ -0,0 +1,188 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from inpaint_engine import InpaintEngine, get_engine
+
+MEMORY_BUDGET = 256 * 1024 * 1024
+DISK_BUDGET = 2 * 1024 * 1024 * 1024
+
+
+def cache_key(image, mask, radius, engine):
+    # Content address of one engine call: the exact input pixels, mask,
+    # engine and radius
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (image, mask):
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.shape}{array.dtype}".encode())
+        digest.update(array.data)
+    digest.update(f"{engine.name}:{float(radius)!r}".encode())
+    return digest.hexdigest()
+
+
+class InpaintCache:
+    # LRU cache of engine results keyed by cache_key(). Results live in
+    # memory up to `budget` bytes; with a directory they are also written
+    # there (up to `disk_budget` bytes, least recently used removed first),
+    # so they survive the process and can be shared between workers.
+    # Cached arrays are read-only.
+    def __init__(self, budget=MEMORY_BUDGET, directory=None, disk_budget=DISK_BUDGET):
+        self.budget = budget
+        self.directory = directory
+        self.disk_budget = disk_budget
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.disk_entries = OrderedDict()
+        self.disk_nbytes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.scan_directory()
+
+    def engine(self, engine):
+        return CachedEngine(engine, self)
+
+    def inpaint(self, engine, image, mask, radius):
+        engine = get_engine(engine)
+        key = cache_key(image, mask, radius, engine)
+        pixels = self.get(key)
+        if pixels is not None:
+            return pixels
+        pixels = engine.inpaint(image, mask, radius)
+        self.put(key, pixels)
+        return pixels
+
+    def get(self, key):
+        with self.lock:
+            pixels = self.entries.get(key)
+            if pixels is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return pixels
+        pixels = self.read(key)
+        with self.lock:
+            if pixels is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.stats["disk_hits"] += 1
+            self.remember(key, pixels)
+        return pixels
+
+    def put(self, key, pixels):
+        pixels = pixels.copy()
+        pixels.flags.writeable = False
+        with self.lock:
+            self.remember(key, pixels)
+        if self.directory is not None:
+            self.write(key, pixels)
+
+    def remember(self, key, pixels):
+        # Memory tier; the caller holds the lock
+        if pixels.nbytes > self.budget:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.entries[key] = pixels
+        self.nbytes += pixels.nbytes
+        while self.nbytes > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def scan_directory(self):
+        # Oldest first, by modification time, which hits refresh
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            found.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(found):
+            self.disk_entries[key] = size
+            self.disk_nbytes += size
+
+    def read(self, key):
+        if self.directory is None:
+            return None
+        path = self.path(key)
+        try:
+            pixels = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # Never written, or removed by another process sharing the
+            # directory
+            return None
+        pixels.flags.writeable = False
+        with self.lock:
+            if key in self.disk_entries:
+                self.disk_entries.move_to_end(key)
+        return pixels
+
+    def write(self, key, pixels):
+        # Written under a temporary name and renamed, so readers in other
+        # processes never see a partial file
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, pixels)
+            os.replace(tmp, self.path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        size = os.path.getsize(self.path(key))
+        with self.lock:
+            self.disk_nbytes += size - self.disk_entries.pop(key, 0)
+            self.disk_entries[key] = size
+            evicted = []
+            while self.disk_nbytes > self.disk_budget and len(self.disk_entries) > 1:
+                old, old_size = self.disk_entries.popitem(last=False)
+                self.disk_nbytes -= old_size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except OSError:
+                pass
+
+    def take_stats(self):
+        # Counts since the last call
+        with self.lock:
+            stats = dict(self.stats)
+            for name in self.stats:
+                self.stats[name] = 0
+        return stats
+
+    def summary(self):
+        hits, misses = self.stats["hits"], self.stats["misses"]
+        text = f"cache {hits} hits / {misses} misses, {self.nbytes / 2 ** 20:.0f} MB"
+        if self.stats["disk_hits"]:
+            text += f" ({self.stats['disk_hits']} hits from disk)"
+        return text
+
+
+class CachedEngine(InpaintEngine):
+    # Any engine with its results looked up in, and added to, an
+    # InpaintCache; usable wherever an engine is accepted
+    def __init__(self, engine, cache):
+        self.engine = get_engine(engine)
+        self.name = self.engine.name
+        self.cache = cache
+
+    def halo(self, radius, bbox):
+        return self.engine.halo(radius, bbox)
+
+    def inpaint(self, image, mask, radius):
+        return self.cache.inpaint(self.engine, image, mask, radius)
@@ -0,0 +1,166 @@
+import cv2
+import numpy as np
+
+from patchmatch import patchmatch_inpaint
+
+
+def inpaint_margin(radius):
+    # cv2.inpaint rounds the radius and clamps it to [1, 100]; known pixels up
+    # to that distance from the mask (plus one more for the gradient stencil)
+    # feed into the result, so this is the smallest halo that stays exact.
+    return min(100, max(1, int(round(radius)))) + 2
+
+
+def mask_bbox(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1] + 1), int(rows[-1] + 1)
+
+
+def union_rect(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+class InpaintEngine:
+    # An inpainting algorithm. inpaint() fills the masked pixels and returns
+    # a new array; halo() is how far outside the mask's bounding box the
+    # engine reads, which is what callers cropping to the mask rely on.
+    name = None
+
+    def halo(self, radius, bbox):
+        return inpaint_margin(radius)
+
+    def inpaint(self, image, mask, radius):
+        raise NotImplementedError
+
+
+class OpenCVEngine(InpaintEngine):
+    def __init__(self, name, flags):
+        self.name = name
+        self.flags = flags
+
+    def inpaint(self, image, mask, radius):
+        return cv2.inpaint(image, mask, radius, self.flags)
+
+
+# Widest ring of known pixels PatchMatch searches around a mask; a ring
+# this wide around a large hole already holds far more texture than the
+# hole needs
+PATCHMATCH_MAX_HALO = 256
+
+
+class PatchMatchEngine(InpaintEngine):
+    # Copies texture from around the mask instead of diffusing colour into
+    # it; see patchmatch.py. The radius is unused.
+    name = "patchmatch"
+
+    def halo(self, radius, bbox):
+        # Enough surrounding texture to copy from: as wide as the mask's
+        # short side, up to PATCHMATCH_MAX_HALO. The long side would make
+        # the window of a banner-shaped mask nearly the whole frame.
+        x0, y0, x1, y1 = bbox
+        return max(inpaint_margin(radius), min(x1 - x0, y1 - y0, PATCHMATCH_MAX_HALO))
+
+    def inpaint(self, image, mask, radius):
+        return patchmatch_inpaint(image, mask)
+
+
+ENGINES = {}
+
+
+def register_engine(engine):
+    ENGINES[engine.name] = engine
+
+
+register_engine(OpenCVEngine("telea", cv2.INPAINT_TELEA))
+register_engine(OpenCVEngine("ns", cv2.INPAINT_NS))
+register_engine(PatchMatchEngine())
+
+
+def get_engine(engine):
+    # Accepts an engine, a registered name, or a cv2.INPAINT_* flag
+    if isinstance(engine, InpaintEngine):
+        return engine
+    if isinstance(engine, str):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown inpainting engine: {engine}")
+        return ENGINES[engine]
+    for candidate in ENGINES.values():
+        if isinstance(candidate, OpenCVEngine) and candidate.flags == engine:
+            return candidate
+    raise ValueError(f"Unknown inpainting engine: {engine}")
+
+
+def crop_window(mask, radius, engine=cv2.INPAINT_TELEA):
+    bbox = mask_bbox(mask)
+    if bbox is None:
+        return None
+    x0, y0, x1, y1 = bbox
+    m = get_engine(engine).halo(radius, bbox)
+    h, w = mask.shape[:2]
+    return max(0, x0 - m), max(0, y0 - m), min(w, x1 + m), min(h, y1 + m)
+
+
+def inpaint_region(image, mask, radius=3, engine=cv2.INPAINT_TELEA, dst=None):
+    # Same pixels as running the engine on the full frame, but only the
+    # mask's bounding box plus the engine's halo is processed. The result is
+    # written into dst (a copy of image by default) and returned.
+    patch = inpaint_patch(image, mask, radius, engine)
+    if dst is None:
+        dst = image.copy()
+    elif dst is not image:
+        dst[...] = image
+    if patch is not None:
+        (x0, y0, x1, y1), pixels = patch
+        dst[y0:y1, x0:x1] = pixels
+    return dst
+
+
+def inpaint_patch(image, mask, radius=3, engine=cv2.INPAINT_TELEA):
+    # The window inpaint_region changes and its new pixels, as
+    # (rect, pixels), or None for an empty mask. image is left untouched,
+    # so callers editing in place can keep what the window held before.
+    engine = get_engine(engine)
+    window = crop_window(mask, radius, engine)
+    if window is None:
+        return None
+    x0, y0, x1, y1 = window
+    return window, engine.inpaint(
+        np.ascontiguousarray(image[y0:y1, x0:x1]),
+        np.ascontiguousarray(mask[y0:y1, x0:x1]),
+        radius
+    )
+
+
+def rect_mask(shape, roi):
+    x, y, w, h = [int(i) for i in roi]
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    mask[y:y+h, x:x+w] = 255
+    return mask
+
+
+def inpaint_preview(image, mask, window, scale, radius=3, engine=cv2.INPAINT_TELEA):
+    # Quick approximation of inpaint_region for display: the window is
+    # inpainted at `scale` and scaled back up. Returns the full-resolution
+    # pixels of the window.
+    x0, y0, x1, y1 = window
+    region = image[y0:y1, x0:x1]
+    region_mask = mask[y0:y1, x0:x1]
+    w = max(1, int(round((x1 - x0) * scale)))
+    h = max(1, int(round((y1 - y0) * scale)))
+    small = cv2.resize(region, (w, h), interpolation=cv2.INTER_AREA)
+    # Any partially covered pixel counts as masked so no watermark edge
+    # survives the downscale
+    small_mask = cv2.resize(region_mask, (w, h), interpolation=cv2.INTER_AREA)
+    small_mask[small_mask > 0] = 255
+    small = get_engine(engine).inpaint(small, small_mask, max(1, radius * scale))
+    filled = cv2.resize(small, (x1 - x0, y1 - y0), interpolation=cv2.INTER_LINEAR)
+    pixels = region.copy()
+    np.copyto(pixels, filled, where=(region_mask > 0)[..., None] if filled.ndim == 3 else region_mask > 0)
+    return pixels
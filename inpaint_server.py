@@ -0,0 +1,491 @@
+import argparse
+import asyncio
+import math
+import os
+import re
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+from batch_remove import parse_roi
+from image_buffer import FORMATS, ImageBuffer
+from inpaint_engine import ENGINES, inpaint_region, rect_mask
+
+# Requests waiting for a worker; past this, new ones get 429
+QUEUE_SIZE = 32
+
+# Most requests handed to a worker in one round trip. Only requests that are
+# already waiting are grouped, and each dispatcher takes no more than its
+# share of them, so a lone request is never held back and no worker idles
+# while another works through a batch.
+BATCH_SIZE = 4
+
+MAX_BODY = 64 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Seconds a client may take to send the next line or body chunk
+IO_TIMEOUT = 30
+
+# How often a queued request checks that its client is still connected
+DISCONNECT_POLL = 0.25
+
+RETRY_AFTER = 1
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    411: "Length Required", 413: "Payload Too Large", 429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or REASONS[status])
+        self.status = status
+
+
+class BadInput(ValueError):
+    # The client's fault: an upload that doesn't decode or doesn't fit
+    pass
+
+
+def init_worker():
+    # Parallelism comes from the pool; keep OpenCV from oversubscribing cores
+    cv2.setNumThreads(1)
+
+
+def run_job(job):
+    # Decode, inpaint and encode one request in a pool process, as
+    # RemoveWatermark does for a file
+    image = cv2.imdecode(np.frombuffer(job["image"], np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise BadInput("Could not decode the image")
+    if job["mask"] is not None:
+        mask = cv2.imdecode(np.frombuffer(job["mask"], np.uint8), cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise BadInput("Could not decode the mask")
+        if mask.shape != image.shape[:2]:
+            raise BadInput(f"Mask is {mask.shape[1]}x{mask.shape[0]}, "
+                             f"image is {image.shape[1]}x{image.shape[0]}")
+        mask[mask > 0] = 255
+    else:
+        mask = rect_mask(image.shape, job["roi"])
+    result = inpaint_region(image, mask, job["radius"], job["engine"])
+    return ImageBuffer(result, "BGR").encode(job["ext"])
+
+
+def run_batch(jobs):
+    # [(encoded bytes, error, seconds)] for each job, so one bad input does
+    # not fail the others sharing its round trip. error is (HTTP status,
+    # message): 400 for bad input, 500 for anything else going wrong.
+    results = []
+    for job in jobs:
+        start = time.perf_counter()
+        try:
+            results.append((run_job(job), None, time.perf_counter() - start))
+        except BadInput as e:
+            results.append((None, (400, str(e)), time.perf_counter() - start))
+        except Exception as e:
+            results.append((None, (500, str(e)), time.perf_counter() - start))
+    return results
+
+
+class Histogram:
+    # Prometheus-style histogram: cumulative bucket counts, sum and count
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum:.6f}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+def multipart_fields(content_type, body):
+    # {name: bytes} for the parts of a multipart/form-data body
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if match is None:
+        raise HTTPError(400, "Multipart body without a boundary")
+    delimiter = b"\r\n--" + match.group(1).encode("latin-1")
+    fields = {}
+    for part in (b"\r\n" + body).split(delimiter)[1:]:
+        if part.startswith(b"--"):
+            break
+        head, _, data = part.partition(b"\r\n\r\n")
+        name = re.search(rb'name="([^"]*)"', head)
+        if name is not None:
+            fields[name.group(1).decode("utf-8", "replace")] = data
+    return fields
+
+
+def parse_job(query, headers, body):
+    # The job for a POST /inpaint: the image is the body, or the "image"
+    # part of a multipart form with an optional "mask" part. roi, radius,
+    # algorithm and format come from the query string or form fields.
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    image, mask = body, None
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        fields = multipart_fields(content_type, body)
+        image, mask = fields.pop("image", None), fields.pop("mask", None)
+        for name, value in fields.items():
+            params.setdefault(name, value.decode("utf-8", "replace"))
+        if image is None:
+            raise HTTPError(400, 'Multipart body without an "image" part')
+    if not image:
+        raise HTTPError(400, "Empty image")
+
+    roi = None
+    if "roi" in params:
+        try:
+            roi = parse_roi(params["roi"])
+        except argparse.ArgumentTypeError as e:
+            raise HTTPError(400, str(e))
+    elif mask is None:
+        raise HTTPError(400, "Give a roi=x,y,w,h or a mask")
+    try:
+        radius = float(params.get("radius", 3))
+    except ValueError:
+        raise HTTPError(400, "radius must be a number")
+    engine = params.get("algorithm", "telea")
+    if engine not in ENGINES:
+        raise HTTPError(400, f"algorithm must be one of {', '.join(sorted(ENGINES))}")
+    ext = "." + params.get("format", "png").lower()
+    if ext not in FORMATS:
+        raise HTTPError(400, "format must be png, jpg or webp")
+    return {"image": image, "mask": mask, "roi": roi, "radius": radius, "engine": engine, "ext": ext}
+
+
+async def read_line(reader):
+    return await asyncio.wait_for(reader.readline(), IO_TIMEOUT)
+
+
+async def read_request(reader):
+    # (method, path, query, headers, keep_alive), or None once the client
+    # closes the connection
+    line = await read_line(reader)
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await read_line(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        keep_alive = connection == "keep-alive"
+    else:
+        keep_alive = connection != "close"
+    url = urlsplit(target)
+    return method, url.path, url.query, headers, keep_alive
+
+
+async def read_body(reader, headers, limit):
+    # The request body, read in chunks as it arrives into one preallocated
+    # buffer where the length is known
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            try:
+                size = int((await read_line(reader)).split(b";")[0], 16)
+            except ValueError:
+                raise HTTPError(400, "Malformed chunked body")
+            if size == 0:
+                while (await read_line(reader)) not in (b"\r\n", b"\n", b""):
+                    pass
+                return body
+            if len(body) + size > limit:
+                raise HTTPError(413)
+            body += await asyncio.wait_for(reader.readexactly(size + 2), IO_TIMEOUT)
+            del body[-2:]
+    if "content-length" not in headers:
+        raise HTTPError(411)
+    try:
+        length = int(headers["content-length"])
+    except ValueError:
+        raise HTTPError(400, "Malformed Content-Length")
+    if length > limit:
+        raise HTTPError(413)
+    body = bytearray(length)
+    view = memoryview(body)
+    received = 0
+    while received < length:
+        chunk = await asyncio.wait_for(reader.read(min(CHUNK_SIZE, length - received)), IO_TIMEOUT)
+        if not chunk:
+            raise asyncio.IncompleteReadError(bytes(view[:received]), length)
+        view[received:received + len(chunk)] = chunk
+        received += len(chunk)
+    return body
+
+
+class InpaintServer:
+    # HTTP front end on asyncio with the inpainting on a process pool kept
+    # warm for the life of the server. Requests wait in a bounded queue;
+    # one dispatcher per worker takes its share of what is waiting (up to
+    # batch_size requests) to the pool, and the result is streamed back.
+    def __init__(self, workers=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, max_body=MAX_BODY):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_body = max_body
+        self.pool = None
+        self.queue = None
+        self.in_flight = 0
+        self.responses = {}
+        self.rejected = 0
+        self.batches = 0
+        self.request_seconds = Histogram("inpaint_request_seconds",
+                                         "Time from request headers to the last response byte")
+        self.queue_seconds = Histogram("inpaint_queue_seconds", "Time requests waited for a worker")
+        self.process_seconds = Histogram("inpaint_process_seconds",
+                                         "Time a worker spent decoding, inpainting and encoding")
+
+    async def serve(self, host, port):
+        loop = asyncio.get_running_loop()
+        self.pool = ProcessPoolExecutor(self.workers, initializer=init_worker)
+        # Start every worker now, so no request pays for process startup
+        await asyncio.gather(*(loop.run_in_executor(self.pool, os.getpid) for _ in range(self.workers)))
+        self.queue = asyncio.Queue(self.queue_size)
+        dispatchers = [asyncio.create_task(self.dispatch()) for _ in range(self.workers)]
+        server = await asyncio.start_server(self.handle, host, port)
+        try:
+            # Stopping cleanly also stops the workers
+            loop.add_signal_handler(signal.SIGTERM, server.close)
+        except NotImplementedError:
+            pass
+        print(f"Serving on http://{host}:{port} with {self.workers} workers")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in dispatchers:
+                task.cancel()
+            self.pool.shutdown(cancel_futures=True)
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            share = min(self.batch_size, math.ceil((self.queue.qsize() + 1) / self.workers))
+            while len(batch) < share and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # Clients that went away while queued are not worth a worker
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            now = time.perf_counter()
+            for _, _, queued in batch:
+                self.queue_seconds.observe(now - queued)
+            self.batches += 1
+            self.in_flight += len(batch)
+            pool = self.pool
+            try:
+                results = await loop.run_in_executor(pool, run_batch, [job for job, _, _ in batch])
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool) and self.pool is pool:
+                    # A worker died (out of memory, say). Every dispatcher
+                    # shares the pool, so the first to notice replaces it.
+                    self.pool = ProcessPoolExecutor(self.workers, initializer=init_worker)
+                    pool.shutdown(wait=False, cancel_futures=True)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.in_flight -= len(batch)
+            for (_, future, _), result in zip(batch, results):
+                self.process_seconds.observe(result[2])
+                if not future.done():
+                    future.set_result(result)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                path = None
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, path, query, headers, keep_alive = request
+                    start = time.perf_counter()
+                    status, body, content_type = await self.route(method, path, query, headers, reader)
+                except HTTPError as e:
+                    # The rest of the request may be unread, so the
+                    # connection cannot be reused
+                    await self.respond(writer, e.status, f"{e}\n".encode(), "text/plain; charset=utf-8", False)
+                    if path == "/inpaint":
+                        self.request_seconds.observe(time.perf_counter() - start)
+                    break
+                await self.respond(writer, status, body, content_type, keep_alive)
+                if path == "/inpaint":
+                    self.request_seconds.observe(time.perf_counter() - start)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, query, headers, reader):
+        # (status, body, content type)
+        if path == "/metrics":
+            if method != "GET":
+                raise HTTPError(405)
+            return 200, self.metrics().encode(), "text/plain; version=0.0.4"
+        if path == "/health":
+            if method != "GET":
+                raise HTTPError(405)
+            return 200, b"ok\n", "text/plain; charset=utf-8"
+        if path != "/inpaint":
+            raise HTTPError(404)
+        if method != "POST":
+            raise HTTPError(405)
+        # Turned away before the upload when the queue is already full
+        if self.queue.full():
+            self.rejected += 1
+            raise HTTPError(429, "Queue full, retry later")
+        job = parse_job(query, headers, await read_body(reader, headers, self.max_body))
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((job, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise HTTPError(429, "Queue full, retry later")
+        try:
+            data, error, _ = await self.wait_result(future, reader)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            raise HTTPError(500, str(e))
+        finally:
+            future.cancel()
+        if error is not None:
+            raise HTTPError(*error)
+        return 200, data, CONTENT_TYPES[FORMATS[job["ext"]]]
+
+    async def wait_result(self, future, reader):
+        # The request has been read in full, so EOF before the response
+        # means the client went away; the future is then cancelled and the
+        # dispatcher skips it.
+        while not future.done():
+            if reader.at_eof() or reader.exception() is not None:
+                raise ConnectionError("client disconnected")
+            await asyncio.wait([future], timeout=DISCONNECT_POLL)
+        return future.result()
+
+    async def respond(self, writer, status, body, content_type, keep_alive):
+        # The body goes out in chunks, each waiting for the socket to drain,
+        # so a slow client holds back only its own response
+        self.responses[status] = self.responses.get(status, 0) + 1
+        head = [
+            f"HTTP/1.1 {status} {REASONS[status]}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            "Connection: " + ("keep-alive" if keep_alive else "close"),
+        ]
+        if status == 429:
+            head.append(f"Retry-After: {RETRY_AFTER}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        view = memoryview(body)
+        for offset in range(0, len(body), CHUNK_SIZE):
+            writer.write(view[offset:offset + CHUNK_SIZE])
+            await asyncio.wait_for(writer.drain(), IO_TIMEOUT)
+        await asyncio.wait_for(writer.drain(), IO_TIMEOUT)
+
+    def metrics(self):
+        lines = [
+            "# HELP inpaint_queue_depth Requests waiting for a worker",
+            "# TYPE inpaint_queue_depth gauge",
+            f"inpaint_queue_depth {self.queue.qsize()}",
+            "# HELP inpaint_queue_capacity Requests that can wait before new ones get 429",
+            "# TYPE inpaint_queue_capacity gauge",
+            f"inpaint_queue_capacity {self.queue_size}",
+            "# HELP inpaint_in_flight Requests being processed by workers",
+            "# TYPE inpaint_in_flight gauge",
+            f"inpaint_in_flight {self.in_flight}",
+            "# HELP inpaint_workers Worker processes",
+            "# TYPE inpaint_workers gauge",
+            f"inpaint_workers {self.workers}",
+            "# HELP inpaint_rejected_total Requests turned away with 429",
+            "# TYPE inpaint_rejected_total counter",
+            f"inpaint_rejected_total {self.rejected}",
+            "# HELP inpaint_batches_total Round trips to the worker pool",
+            "# TYPE inpaint_batches_total counter",
+            f"inpaint_batches_total {self.batches}",
+            "# HELP http_responses_total Responses sent, by status code",
+            "# TYPE http_responses_total counter",
+        ]
+        for status in sorted(self.responses):
+            lines.append(f'http_responses_total{{code="{status}"}} {self.responses[status]}')
+        for histogram in (self.request_seconds, self.queue_seconds, self.process_seconds):
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Serve watermark inpainting over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes (default: all cores)")
+    parser.add_argument("--queue", type=int, default=QUEUE_SIZE,
+                        help="requests that may wait for a worker before new ones get 429 "
+                             "(default: %(default)s)")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE,
+                        help="most waiting requests sent to a worker at once; each worker takes at most "
+                             "its share of the queue (default: %(default)s)")
+    parser.add_argument("--max-body-mb", type=int, default=MAX_BODY // 2 ** 20,
+                        help="largest accepted upload in MB (default: %(default)s)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.queue < 1 or args.batch < 1:
+        print("Error: --queue and --batch must be at least 1")
+        return 1
+    server = InpaintServer(args.workers, args.queue, args.batch, args.max_body_mb * 2 ** 20)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
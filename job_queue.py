@@ -0,0 +1,493 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import Process
+
+import cv2
+import numpy as np
+
+from batch_remove import collect_inputs, load_mask, output_names, parse_roi
+from image_buffer import ImageBuffer
+from inpaint_engine import ENGINES, inpaint_region, rect_mask
+
+STATES = ("pending", "claimed", "done", "failed")
+
+# A claim not refreshed for this long is taken to belong to a dead worker
+# and the job goes back to the queue
+LEASE_SECONDS = 600
+
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 3600
+
+# Idle workers look for new or retryable jobs this often with --wait
+POLL_SECONDS = 5
+
+# Window for the throughput figure in `status`
+RATE_WINDOW = 600
+
+
+def job_id(path):
+    # Stable per input, so submitting a path again never duplicates it
+    return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:20]
+
+
+def write_json(path, data):
+    # Written under a temporary name and renamed, so other processes and
+    # hosts only ever see whole files
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def claim_age(entry, now):
+    # Seconds since a claim was made or last refreshed. A rename keeps the
+    # pending file's modification time but updates its change time.
+    info = entry.stat()
+    return now - max(info.st_mtime, info.st_ctime)
+
+
+def stale(record, age, host, lease):
+    # A claim whose worker is gone: a process on this host that no longer
+    # exists, or a claim not refreshed within the lease. A claim without a
+    # worker has been renamed but not yet rewritten by its claimer, and
+    # only goes once a whole lease has passed since the rename.
+    worker = record.get("worker")
+    if not worker:
+        return age >= lease
+    worker_host, _, pid = str(worker).rpartition(":")
+    if worker_host == host and pid.isdigit() and not pid_alive(int(pid)):
+        return True
+    return age >= lease
+
+
+class Spool:
+    # A work queue in a directory, shareable between hosts over a network
+    # filesystem. Each job is a JSON file in pending/, claimed/, done/ or
+    # failed/; a worker claims a job by renaming it from pending/ to
+    # claimed/, which succeeds for exactly one worker. done/ is the
+    # checkpoint: an interrupted run resumes where it stopped.
+    def __init__(self, path):
+        self.path = path
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    def dir(self, state):
+        return os.path.join(self.path, state)
+
+    def job_path(self, state, job):
+        return os.path.join(self.dir(state), job + ".json")
+
+    @property
+    def settings_path(self):
+        return os.path.join(self.path, "queue.json")
+
+    def create(self, settings):
+        for state in STATES:
+            os.makedirs(self.dir(state), exist_ok=True)
+        write_json(self.settings_path, settings)
+
+    def settings(self):
+        return read_json(self.settings_path)
+
+    def outputs(self):
+        # Output names already given to jobs
+        names = set()
+        for state in STATES:
+            for entry in os.scandir(self.dir(state)):
+                if entry.name.endswith(".json"):
+                    try:
+                        names.add(read_json(entry.path).get("output"))
+                    except (OSError, ValueError):
+                        pass
+        return names
+
+    def submit(self, paths):
+        # Returns how many jobs were new. Outputs mirror the inputs' paths
+        # below their common directory; a name an earlier submission
+        # already uses gets the job id added.
+        added = 0
+        taken = self.outputs()
+        for path, name in zip(paths, output_names(paths)):
+            job = job_id(path)
+            if any(os.path.exists(self.job_path(state, job)) for state in STATES):
+                continue
+            if name in taken:
+                root, ext = os.path.splitext(name)
+                name = f"{root}.{job}{ext}"
+            taken.add(name)
+            write_json(self.job_path("pending", job), {
+                "id": job, "input": os.path.abspath(path), "output": name,
+                "attempts": 0, "not_before": 0, "error": None,
+            })
+            added += 1
+        return added
+
+    def claim(self):
+        # The first pending job whose backoff has passed, now owned by this
+        # worker, or None
+        now = time.time()
+        for name in sorted(os.listdir(self.dir("pending"))):
+            if not name.endswith(".json"):
+                continue
+            source = os.path.join(self.dir("pending"), name)
+            try:
+                record = read_json(source)
+            except (OSError, ValueError):
+                continue
+            if record["not_before"] > now:
+                continue
+            target = os.path.join(self.dir("claimed"), name)
+            try:
+                os.rename(source, target)
+            except FileNotFoundError:
+                # Another worker got there first
+                continue
+            # The claim's age counts from now, not from submission
+            os.utime(target)
+            record.update(worker=self.worker, claimed_at=now)
+            write_json(target, record)
+            return record
+        return None
+
+    def heartbeat(self, record):
+        try:
+            os.utime(self.job_path("claimed", record["id"]))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, record, seconds):
+        record.update(finished_at=time.time(), seconds=seconds, error=None)
+        self.move(record, "done")
+
+    def fail(self, record, error, max_attempts=MAX_ATTEMPTS):
+        # Back to the queue with exponential backoff, or to failed/ once
+        # out of attempts
+        record["attempts"] += 1
+        record["error"] = error
+        if record["attempts"] >= max_attempts:
+            self.move(record, "failed")
+            return
+        delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (record["attempts"] - 1))
+        record["not_before"] = time.time() + delay
+        self.move(record, "pending")
+
+    def move(self, record, state):
+        # Only the claim's owner moves it on; if the claim was reclaimed as
+        # stale meanwhile, the job's new owner records the outcome instead
+        source = self.job_path("claimed", record["id"])
+        if not os.path.exists(source) or read_json(source).get("worker") != self.worker:
+            return
+        write_json(source, record)
+        os.replace(source, self.job_path(state, record["id"]))
+
+    def reclaim_stale(self, lease=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        # Claims whose worker died: same host and the process is gone, or
+        # not refreshed within the lease. Counts as a failed attempt, so a
+        # job that keeps killing workers ends up in failed/.
+        now = time.time()
+        host = socket.gethostname()
+        reclaimed = 0
+        for entry in os.scandir(self.dir("claimed")):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                record = read_json(entry.path)
+                age = claim_age(entry, now)
+            except (OSError, ValueError):
+                continue
+            if not stale(record, age, host, lease):
+                continue
+            record["attempts"] += 1
+            record["error"] = f"worker {record.get('worker')} stopped"
+            state = "failed" if record["attempts"] >= max_attempts else "pending"
+            target = self.job_path(state, record["id"])
+            try:
+                os.rename(entry.path, target)
+            except FileNotFoundError:
+                continue
+            record["not_before"] = 0
+            write_json(target, record)
+            reclaimed += 1
+        return reclaimed
+
+    def retry_failed(self):
+        count = 0
+        for entry in os.scandir(self.dir("failed")):
+            if not entry.name.endswith(".json"):
+                continue
+            target = os.path.join(self.dir("pending"), entry.name)
+            try:
+                os.rename(entry.path, target)
+            except FileNotFoundError:
+                continue
+            record = read_json(target)
+            record.update(attempts=0, not_before=0)
+            write_json(target, record)
+            count += 1
+        return count
+
+    def status(self, window=RATE_WINDOW, lease=LEASE_SECONDS):
+        now = time.time()
+        host = socket.gethostname()
+        counts = {state: 0 for state in STATES}
+        waiting = 0
+        stalled = 0
+        recent = 0
+        oldest = now
+        for state in STATES:
+            for entry in os.scandir(self.dir(state)):
+                if not entry.name.endswith(".json"):
+                    continue
+                counts[state] += 1
+                if state == "pending":
+                    try:
+                        if read_json(entry.path)["not_before"] > now:
+                            waiting += 1
+                    except (OSError, ValueError):
+                        pass
+                elif state == "claimed":
+                    try:
+                        if stale(read_json(entry.path), claim_age(entry, now), host, lease):
+                            stalled += 1
+                    except (OSError, ValueError):
+                        pass
+                elif state == "done":
+                    finished = entry.stat().st_mtime
+                    if now - finished <= window:
+                        recent += 1
+                        oldest = min(oldest, finished)
+        # Jobs per minute over the window, or over the part of it since
+        # the run started
+        return {
+            "counts": counts,
+            "waiting": waiting,
+            "stalled": stalled,
+            "rate": recent / max(1.0, now - oldest) * 60 if recent else 0.0,
+        }
+
+
+def process_job(record, settings, mask_cache):
+    # The RemoveWatermark pipeline: load, inpaint the watermark area, save.
+    # The output is written under a temporary name and renamed, so a job
+    # run twice or cut short never leaves a partial file.
+    image = cv2.imread(record["input"])
+    if image is None:
+        raise ValueError("Could not load image")
+    key = image.shape[:2]
+    mask = mask_cache.get(key)
+    if mask is None:
+        if settings["mask"]:
+            mask = load_mask(settings["mask"])
+            if mask.shape[:2] != key:
+                raise ValueError(f"mask is {mask.shape[1]}x{mask.shape[0]}, image is {key[1]}x{key[0]}")
+        else:
+            mask = rect_mask(image.shape, settings["roi"])
+        mask_cache[key] = mask
+    result = inpaint_region(image, mask, settings["radius"], settings["engine"])
+
+    output = os.path.join(settings["output"], record.get("output") or os.path.basename(record["input"]))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    root, ext = os.path.splitext(output)
+    tmp = f"{root}.{socket.gethostname()}-{os.getpid()}.tmp{ext}"
+    try:
+        ImageBuffer(result, "BGR").save(tmp)
+        os.replace(tmp, output)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def keep_alive(spool, record, interval, stop):
+    # Refreshes the claim until stop is set, so a job that runs longer than
+    # the lease is not taken for abandoned
+    while not stop.wait(interval):
+        spool.heartbeat(record)
+
+
+def work(spool_path, wait=False, lease=LEASE_SECONDS):
+    # One worker: claims and runs jobs until none are left, or forever with
+    # wait=True
+    cv2.setNumThreads(1)
+    spool = Spool(spool_path)
+    settings = spool.settings()
+    max_attempts = settings.get("max_attempts", MAX_ATTEMPTS)
+    masks = {}
+    while True:
+        record = spool.claim()
+        if record is None and spool.reclaim_stale(lease, max_attempts):
+            record = spool.claim()
+        if record is None:
+            if not wait and not os.listdir(spool.dir("pending")):
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        start = time.perf_counter()
+        stop = threading.Event()
+        beat = threading.Thread(target=keep_alive, args=(spool, record, lease / 4, stop), daemon=True)
+        beat.start()
+        try:
+            process_job(record, settings, masks)
+        except Exception as e:
+            spool.fail(record, str(e), max_attempts)
+            print(f"Error: {record['input']}: {e}", file=sys.stderr)
+            continue
+        finally:
+            stop.set()
+            beat.join()
+        spool.complete(record, time.perf_counter() - start)
+
+
+def changed_settings(args, settings):
+    # Options given to submit that differ from the spool's settings, as
+    # "--option value (spool has value)" lines
+    given = {
+        "--output": (args.output and os.path.abspath(args.output), settings["output"]),
+        "--roi": (args.roi and list(args.roi), settings["roi"]),
+        "--algorithm": (args.algorithm, settings["engine"]),
+        "--radius": (args.radius, settings["radius"]),
+        "--max-attempts": (args.max_attempts, settings.get("max_attempts", MAX_ATTEMPTS)),
+    }
+    changed = [f"{name} {value} (spool has {stored})" for name, (value, stored) in given.items()
+               if value is not None and value != stored]
+    if args.mask and (settings["mask"] is None or
+                      not np.array_equal(load_mask(args.mask), load_mask(settings["mask"]))):
+        changed.append(f"--mask {args.mask} (spool has {settings['mask'] or 'none'})")
+    return changed
+
+
+def cmd_submit(args):
+    spool = Spool(args.spool)
+    if os.path.exists(spool.settings_path):
+        settings = spool.settings()
+        changed = changed_settings(args, settings)
+        if changed:
+            # The spool keeps the settings it was created with
+            print("Error: the spool was created with other settings:\n  " + "\n  ".join(changed))
+            return 1
+    else:
+        if args.output is None or (args.roi is None and args.mask is None):
+            print("Error: a new spool needs -o and --roi or --mask")
+            return 1
+        os.makedirs(args.output, exist_ok=True)
+        settings = {
+            "output": os.path.abspath(args.output),
+            "roi": args.roi,
+            "mask": None,
+            "engine": args.algorithm or "telea",
+            "radius": 3 if args.radius is None else args.radius,
+            "max_attempts": MAX_ATTEMPTS if args.max_attempts is None else args.max_attempts,
+        }
+        os.makedirs(args.spool, exist_ok=True)
+        if args.mask:
+            # Kept with the spool so workers on other hosts find it
+            load_mask(args.mask)
+            settings["mask"] = os.path.abspath(os.path.join(args.spool, "mask.png"))
+            shutil.copyfile(args.mask, settings["mask"])
+        spool.create(settings)
+
+    paths = collect_inputs(args.input)
+    output_dir = os.path.realpath(settings["output"])
+    paths = [p for p in paths if os.path.dirname(os.path.realpath(p)) != output_dir]
+    if not paths:
+        print("Error: No input images found")
+        return 1
+    added = spool.submit(paths)
+    print(f"Queued {added} new jobs ({len(paths) - added} already known)")
+    return 0
+
+
+def cmd_work(args):
+    workers = [Process(target=work, args=(args.spool, args.wait, args.lease)) for _ in range(max(1, args.workers))]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    return cmd_status(args)
+
+
+def cmd_status(args):
+    info = Spool(args.spool).status()
+    counts = info["counts"]
+    total = sum(counts.values())
+    backlog = counts["pending"] + counts["claimed"]
+    print(f"{total} jobs: {counts['done']} done, {counts['claimed']} running ({info['stalled']} abandoned), "
+          f"{counts['pending']} pending ({info['waiting']} backing off), {counts['failed']} failed")
+    if info["rate"] > 0:
+        print(f"Throughput: {info['rate']:.1f} jobs/min over the last {RATE_WINDOW // 60} min, "
+              f"backlog clears in about {backlog / info['rate']:.1f} min")
+    elif backlog:
+        print("Throughput: no jobs finished recently")
+    return 0
+
+
+def cmd_retry(args):
+    print(f"Requeued {Spool(args.spool).retry_failed()} failed jobs")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Resumable watermark removal through a job spool directory. Put the spool, "
+                    "inputs and output on storage every worker host sees at the same paths.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser("submit", help="create a spool or add inputs to it")
+    submit.add_argument("spool")
+    submit.add_argument("input", help="input directory or glob pattern")
+    submit.add_argument("-o", "--output", help="output directory; a spool keeps the settings it was created with")
+    region = submit.add_mutually_exclusive_group()
+    region.add_argument("--roi", type=parse_roi, help="watermark rectangle as x,y,w,h")
+    region.add_argument("--mask", help="mask image; non-zero pixels are inpainted")
+    submit.add_argument("--algorithm", choices=sorted(ENGINES), help="(default: telea)")
+    submit.add_argument("--radius", type=float, help="(default: 3)")
+    submit.add_argument("--max-attempts", type=int, help=f"(default: {MAX_ATTEMPTS})")
+    submit.set_defaults(run=cmd_submit)
+
+    worker = commands.add_parser("work", help="run workers on this host")
+    worker.add_argument("spool")
+    worker.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    worker.add_argument("--wait", action="store_true", help="keep polling for new jobs instead of exiting")
+    worker.add_argument("--lease", type=float, default=LEASE_SECONDS,
+                        help="seconds before another worker's claim counts as abandoned (default: %(default)s)")
+    worker.set_defaults(run=cmd_work)
+
+    status = commands.add_parser("status", help="report progress, throughput and backlog")
+    status.add_argument("spool")
+    status.set_defaults(run=cmd_status)
+
+    retry = commands.add_parser("retry", help="requeue jobs that ran out of attempts")
+    retry.add_argument("spool")
+    retry.set_defaults(run=cmd_retry)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
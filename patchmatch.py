@@ -0,0 +1,232 @@
+import cv2
+import numpy as np
+
+PATCH_RADIUS = 3
+EM_ITERATIONS = 3
+SEARCH_ITERATIONS = 2
+# Target patches compared per vectorised batch
+CHUNK = 16384
+
+
+def valid_sources(hole, r):
+    # Centres whose whole patch lies inside the image and outside the hole
+    size = 2 * r + 1
+    blocked = cv2.dilate(hole.astype(np.uint8), np.ones((size, size), np.uint8))
+    valid = blocked == 0
+    valid[:r] = False
+    valid[-r:] = False
+    valid[:, :r] = False
+    valid[:, -r:] = False
+    return valid
+
+
+class Level:
+    # One pyramid level: the image being filled, its hole, and the nearest
+    # neighbour field (one source centre per hole pixel)
+    def __init__(self, image, hole, r, rng):
+        self.image = image
+        self.hole = hole
+        self.r = r
+        self.rng = rng
+        h, w = hole.shape
+        self.ty, self.tx = np.nonzero(hole)
+        self.index = np.full((h, w), -1, dtype=np.int64)
+        self.index[self.ty, self.tx] = np.arange(self.ty.size)
+        self.valid = valid_sources(hole, r)
+        self.vy, self.vx = np.nonzero(self.valid)
+        # Patches are gathered from the border-padded image as flat rows:
+        # centre (y, x) sits at (y + r) * stride + x + r, and the patch is
+        # that index plus each entry of offsets
+        self.stride = w + 2 * r
+        dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+        self.offsets = (dy * self.stride + dx).ravel()
+        self.flat = None
+        self.packed = None
+        self.targets = None
+        self.target_patches = None
+        self.sy = self.sx = self.cost = None
+
+    def linear(self, y, x):
+        return (y + self.r) * self.stride + x + self.r
+
+    def pad(self):
+        r = self.r
+        padded = cv2.copyMakeBorder(self.image, r, r, r, r, cv2.BORDER_REFLECT)
+        channels = self.image.shape[2]
+        self.flat = padded.reshape(-1, channels)
+        # For matching, each pixel is packed into one uint32 so a patch is a
+        # single gather; 8-bit precision is plenty to rank candidates
+        packed = np.zeros((self.flat.shape[0], 4), dtype=np.uint8)
+        packed[:, :channels] = np.clip(np.rint(self.flat), 0, 255)
+        self.packed = packed.view(np.uint32).ravel()
+        self.targets = self.linear(self.ty, self.tx)
+        self.target_patches = self.gather(self.targets)
+
+    def random_sources(self, count):
+        pick = self.rng.integers(0, self.vy.size, count)
+        return self.vy[pick], self.vx[pick]
+
+    def gather(self, centres):
+        return self.packed[centres[:, None] + self.offsets]
+
+    def patch_cost(self, sy, sx, targets=None):
+        # Sum of squared differences between each target patch and its
+        # candidate source patch, in chunks to bound the gathered arrays
+        t = self.target_patches if targets is None else self.target_patches[targets]
+        s = self.linear(sy, sx)
+        cost = np.empty(s.size, dtype=np.int64)
+        for i in range(0, s.size, CHUNK):
+            a = t[i:i + CHUNK].view(np.uint8).astype(np.int32)
+            b = self.gather(s[i:i + CHUNK]).view(np.uint8)
+            diff = a - b
+            cost[i:i + CHUNK] = np.einsum("ij,ij->i", diff, diff)
+        return cost
+
+    def try_candidates(self, cy, cx, targets=None):
+        if targets is None:
+            targets = np.arange(self.ty.size)
+        h, w = self.hole.shape
+        ok = (cy >= 0) & (cy < h) & (cx >= 0) & (cx < w)
+        ok[ok] = self.valid[cy[ok], cx[ok]]
+        if not ok.any():
+            return
+        targets, cy, cx = targets[ok], cy[ok], cx[ok]
+        cost = self.patch_cost(cy, cx, targets)
+        better = cost < self.cost[targets]
+        targets = targets[better]
+        self.sy[targets] = cy[better]
+        self.sx[targets] = cx[better]
+        self.cost[targets] = cost[better]
+
+    def search(self):
+        self.pad()
+        self.cost = self.patch_cost(self.sy, self.sx)
+        h, w = self.hole.shape
+        for _ in range(SEARCH_ITERATIONS):
+            # Propagation, run for all pixels at once: adopt a neighbour's
+            # source shifted by the same offset
+            for dy, dx in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+                ny, nx = self.ty + dy, self.tx + dx
+                inside = (ny >= 0) & (ny < h) & (nx >= 0) & (nx < w)
+                neighbour = np.full(self.ty.size, -1, dtype=np.int64)
+                neighbour[inside] = self.index[ny[inside], nx[inside]]
+                targets = np.nonzero(neighbour >= 0)[0]
+                n = neighbour[targets]
+                self.try_candidates(self.sy[n] - dy, self.sx[n] - dx, targets)
+            # Random search in windows shrinking by half
+            radius = max(h, w) // 2
+            while radius >= 1:
+                cy = self.sy + self.rng.integers(-radius, radius + 1, self.sy.size)
+                cx = self.sx + self.rng.integers(-radius, radius + 1, self.sx.size)
+                self.try_candidates(cy, cx)
+                radius //= 2
+
+    def vote(self):
+        # Every hole pixel becomes the mean of the source pixels that the
+        # patches covering it map onto
+        r = self.r
+        h, w = self.hole.shape
+        count = self.ty.size
+        channels = self.image.shape[2]
+        total = np.zeros((count, channels), dtype=np.float64)
+        weight = np.zeros(count, dtype=np.float64)
+        sources = self.linear(self.sy, self.sx)
+        for dy in range(-r, r + 1):
+            for dx in range(-r, r + 1):
+                qy, qx = self.ty + dy, self.tx + dx
+                inside = (qy >= 0) & (qy < h) & (qx >= 0) & (qx < w)
+                q = np.full(count, -1, dtype=np.int64)
+                q[inside] = self.index[qy[inside], qx[inside]]
+                use = q >= 0
+                values = self.flat[sources[use] + dy * self.stride + dx]
+                for c in range(channels):
+                    total[:, c] += np.bincount(q[use], values[:, c], minlength=count)
+                weight += np.bincount(q[use], minlength=count)
+        filled = total / np.maximum(weight, 1)[:, None]
+        self.image[self.ty, self.tx] = filled.astype(np.float32)
+
+    def solve(self):
+        for _ in range(EM_ITERATIONS):
+            self.search()
+            self.vote()
+
+
+def pyramid_depth(hole, r):
+    ys, xs = np.nonzero(hole)
+    extent = max(ys.max() - ys.min(), xs.max() - xs.min()) + 1
+    h, w = hole.shape
+    size = 2 * r + 1
+    depth = 0
+    while extent >> (depth + 1) >= 2 * size and min(h, w) >> (depth + 1) >= 4 * size:
+        depth += 1
+    return depth
+
+
+def patchmatch_inpaint(image, mask, patch_radius=PATCH_RADIUS, seed=0):
+    # Exemplar-based inpainting: every masked pixel is rebuilt from patches
+    # copied from the unmasked part of the image, found with a randomised
+    # nearest-neighbour search run coarse to fine. Work per level grows with
+    # the number of masked pixels, not with the image size.
+    hole = mask > 0
+    if not hole.any():
+        return image.copy()
+    squeeze = image.ndim == 2
+    work = image[..., None] if squeeze else image
+    r = patch_radius
+    rng = np.random.default_rng(seed)
+
+    images = [work.astype(np.float32)]
+    holes = [hole]
+    for _ in range(pyramid_depth(hole, r)):
+        prev = images[-1]
+        h, w = prev.shape[:2]
+        small = cv2.resize(prev, (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+        images.append(small.reshape(h // 2, w // 2, -1))
+        small_hole = cv2.resize(holes[-1].astype(np.uint8), (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+        holes.append(small_hole > 0)
+
+    # Coarsest level starts from a diffusion fill and a random field
+    coarse = images[-1]
+    seed_fill = cv2.inpaint(np.clip(coarse, 0, 255).astype(np.uint8),
+                            holes[-1].astype(np.uint8) * 255, r, cv2.INPAINT_TELEA)
+    coarse = seed_fill.reshape(coarse.shape).astype(np.float32)
+    level = Level(coarse, holes[-1], r, rng)
+    if level.vy.size == 0:
+        # Nothing to copy from; fall back to the diffusion result
+        return cv2.inpaint(image, (hole * 255).astype(np.uint8), r, cv2.INPAINT_TELEA)
+    level.sy, level.sx = level.random_sources(level.ty.size)
+    level.solve()
+
+    for depth in range(len(images) - 2, -1, -1):
+        fine_image = images[depth].copy()
+        h, w = fine_image.shape[:2]
+        up = cv2.resize(level.image, (w, h), interpolation=cv2.INTER_LINEAR).reshape(fine_image.shape)
+        fine_hole = holes[depth]
+        fine_image[fine_hole] = up[fine_hole]
+        fine = Level(fine_image, fine_hole, r, rng)
+        if fine.vy.size == 0:
+            return cv2.inpaint(image, (hole * 255).astype(np.uint8), r, cv2.INPAINT_TELEA)
+
+        # Upsample the field: each fine pixel inherits its coarse parent's
+        # source, doubled, where the parent was part of the hole
+        ch, cw = level.hole.shape
+        py = np.minimum(fine.ty // 2, ch - 1)
+        px = np.minimum(fine.tx // 2, cw - 1)
+        parent = level.index[py, px]
+        sy, sx = fine.random_sources(fine.ty.size)
+        known = parent >= 0
+        cy = level.sy[parent[known]] * 2 + (fine.ty[known] & 1)
+        cx = level.sx[parent[known]] * 2 + (fine.tx[known] & 1)
+        cy = np.clip(cy, 0, h - 1)
+        cx = np.clip(cx, 0, w - 1)
+        keep = fine.valid[cy, cx]
+        idx = np.nonzero(known)[0][keep]
+        sy[idx], sx[idx] = cy[keep], cx[keep]
+        fine.sy, fine.sx = sy, sx
+        fine.solve()
+        level = fine
+
+    result = work.copy()
+    filled = np.clip(np.rint(level.image), 0, 255).astype(image.dtype)
+    result[hole] = filled[hole]
+    return result[..., 0] if squeeze else result
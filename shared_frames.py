@@ -0,0 +1,152 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from inpaint_engine import get_engine
+
+# Segments mapped into this (worker) process, by name
+_attached = {}
+
+
+def attach(descriptor):
+    # The array a SharedFrames.descriptor() refers to. Each segment is
+    # mapped once and reused by later calls.
+    name, shape, dtype = descriptor
+    shm = _attached.get(name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+    return np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+def detach_except(names):
+    # Segments the owner has replaced are unmapped once a call no longer
+    # names them
+    for name in list(_attached):
+        if name not in names:
+            _attached.pop(name).close()
+
+
+def inpaint_frames(source, mask, result, radius, engine):
+    # Worker side of SharedFrames.inpaint(): source under mask is inpainted
+    # into result, all three in shared memory
+    detach_except({source[0], mask[0], result[0]})
+    attach(result)[...] = get_engine(engine).inpaint(attach(source), attach(mask), radius)
+
+
+class SharedFrames:
+    # Arrays kept in named shared-memory segments, one per slot, and a
+    # worker process that inpaints them in place. A call sends the worker
+    # segment names only, so no pixels are pickled either way.
+    # A slot's segment is reused while the array fits in it, and replaced
+    # (the old one unlinked) when a larger one is needed. close(), also run
+    # at exit, unlinks every segment.
+    def __init__(self):
+        self.segments = {}
+        self.retired = []
+        # retired is also released from the executor's thread
+        self.lock = threading.Lock()
+        self.executor = None
+        atexit.register(self.close)
+
+    def start(self):
+        # Starts the worker ahead of the first call; it is spawned rather
+        # than forked, as Tk and other threads are running
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+            self.executor.submit(os.getpid)
+
+    def frame(self, slot, shape=None, dtype=np.uint8):
+        # The array in slot, first resized to shape if given. Its contents
+        # are whatever the segment last held.
+        if shape is not None:
+            shape, dtype = tuple(shape), np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            shm = self.segments[slot][0] if slot in self.segments else None
+            if shm is None or shm.size < nbytes:
+                if shm is not None:
+                    self.retire(shm)
+                shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+            self.segments[slot] = (shm, shape, dtype)
+        shm, shape, dtype = self.segments[slot]
+        return np.ndarray(shape, dtype, buffer=shm.buf)
+
+    def stage(self, slot, pixels):
+        # A copy of pixels in slot, which nothing else writes until the
+        # next stage() into it
+        staged = self.frame(slot, pixels.shape, pixels.dtype)
+        staged[...] = pixels
+        return staged
+
+    def descriptor(self, slot):
+        shm, shape, dtype = self.segments[slot]
+        return shm.name, shape, dtype.str
+
+    def inpaint(self, radius, engine, source="source", mask="mask"):
+        # Inpaints the staged source under the staged mask in the worker
+        # process. Returns the result as a view of the "result" slot, valid
+        # until the next call.
+        _, shape, dtype = self.segments[source]
+        result = self.frame("result", shape, dtype)
+        self.start()
+        try:
+            self.executor.submit(
+                inpaint_frames, self.descriptor(source), self.descriptor(mask), self.descriptor("result"),
+                radius, get_engine(engine).name
+            ).result()
+        except BrokenProcessPool:
+            # The worker died (out of memory, say); the next call starts a
+            # new one
+            self.executor = None
+            raise
+        # The worker has let go of retired segments by now
+        self.release()
+        return result
+
+    def drop(self, slot):
+        # Frees slot's segment, for a frame that is no longer needed
+        if slot in self.segments:
+            self.retire(self.segments.pop(slot)[0])
+
+    def retire(self, shm):
+        # The name goes at once. The memory is freed once our mapping is
+        # unused and the worker has unmapped it, which it is told to do now
+        # rather than on its next call.
+        shm.unlink()
+        with self.lock:
+            self.retired.append(shm)
+        if self.executor is not None:
+            names = {other.name for other, _, _ in self.segments.values()} - {shm.name}
+            try:
+                self.executor.submit(detach_except, names).add_done_callback(lambda _: self.release())
+            except BrokenProcessPool:
+                self.executor = None
+        self.release()
+
+    def release(self):
+        # Closes our mapping of each retired segment no array uses any more
+        with self.lock:
+            still_used = []
+            for shm in self.retired:
+                try:
+                    shm.close()
+                except BufferError:
+                    still_used.append(shm)
+            self.retired = still_used
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        with self.lock:
+            for shm, _, _ in self.segments.values():
+                shm.unlink()
+                self.retired.append(shm)
+        self.segments = {}
+        self.release()
@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+_idle = nullcontext()
+
+
+class Operation:
+    # Wall times of the stages of one user action (opening a file, one
+    # inpainting pass, ...). Stages can be recorded from any thread.
+    def __init__(self, name):
+        self.name = name
+        self.detail = None
+        self.start = time.perf_counter()
+        self.end = None
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, start, time.perf_counter() - start, threading.get_ident()))
+
+    def wrap(self, name, fn):
+        # fn timed as a stage wherever it ends up running, e.g. on a worker
+        def run(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return run
+
+    def totals(self):
+        # Seconds per stage name, in first-seen order
+        totals = {}
+        for name, _, seconds, _ in self.stages:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def summary(self):
+        total = (self.end or time.perf_counter()) - self.start
+        title = self.name if self.detail is None else f"{self.name} ({self.detail})"
+        parts = [f"{name} {seconds * 1000:.0f}" for name, seconds in self.totals().items()]
+        return f"{title}: {total * 1000:.0f} ms" + (" | " + " · ".join(parts) if parts else "")
+
+
+class JsonLinesTrace:
+    # One JSON object per finished operation
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, op, epoch):
+        record = {
+            "operation": op.name,
+            "detail": op.detail,
+            "start": epoch + op.start,
+            "seconds": op.end - op.start,
+            "stages": [
+                {"name": name, "offset": start - op.start, "seconds": seconds, "thread": thread}
+                for name, start, seconds, thread in op.stages
+            ],
+        }
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ChromeTrace:
+    # Trace Event Format, loadable in chrome://tracing or Perfetto. The array
+    # is closed on close(), but viewers also accept a file cut short.
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.file.write("[\n")
+        self.first = True
+        self.threads = {}
+        self.pid = os.getpid()
+
+    def event(self, name, start, seconds, tid, args=None):
+        event = {"name": name, "ph": "X", "ts": start * 1e6, "dur": seconds * 1e6,
+                 "pid": self.pid, "tid": tid}
+        if args:
+            event["args"] = args
+        self.file.write(("" if self.first else ",\n") + json.dumps(event))
+        self.first = False
+
+    def write(self, op, epoch):
+        # Operations on track 0, their stages on one track per thread
+        self.event(op.name, op.start, op.end - op.start, 0, {"detail": op.detail})
+        for name, start, seconds, thread in op.stages:
+            tid = self.threads.setdefault(thread, len(self.threads) + 1)
+            self.event(name, start, seconds, tid)
+        self.file.flush()
+
+    def close(self):
+        self.file.write("\n]\n")
+        self.file.close()
+
+
+class StageProfiler:
+    # Hands out Operations and reports each finished one to on_report and,
+    # when tracing, to the trace file. `active` is the operation that
+    # stage() and operation() calls attach to; with none active they cost a
+    # single attribute check.
+    def __init__(self, widget, on_report=None):
+        self.widget = widget
+        self.on_report = on_report
+        self.active = None
+        self.last = None
+        self.trace = None
+        # Wall-clock time at perf_counter() == 0, for absolute timestamps
+        self.epoch = time.time() - time.perf_counter()
+
+    def begin(self, name):
+        return Operation(name)
+
+    def stage(self, name):
+        if self.active is None:
+            return _idle
+        return self.active.stage(name)
+
+    @contextmanager
+    def operation(self, name):
+        # A stage of the active operation, or a new operation of its own
+        if self.active is not None:
+            with self.active.stage(name):
+                yield self.active
+            return
+        op = self.begin(name)
+        self.settle(op)
+        yield op
+
+    def settle(self, op):
+        # Make op active until the UI goes idle, so the redraws it queued
+        # are counted in it, then finish it
+        self.active = op
+        self.widget.after_idle(self.finish, op)
+
+    def finish(self, op):
+        if self.active is op:
+            self.active = None
+        op.end = time.perf_counter()
+        self.last = op
+        if self.trace is not None:
+            self.trace.write(op, self.epoch)
+        if self.on_report is not None:
+            self.on_report(op.summary())
+
+    def start_trace(self, path):
+        self.stop_trace()
+        if path.lower().endswith(".json"):
+            self.trace = ChromeTrace(path)
+        else:
+            self.trace = JsonLinesTrace(path)
+
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
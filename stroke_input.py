@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+
+FRAME_MS = 16
+
+
+def draw_stroke(mask, points, radius, color):
+    # Draws the samples as one connected polyline with round caps and joins,
+    # as wide as a brush stamp of `radius`. Returns the touched rectangle.
+    pts = np.asarray(points, dtype=np.int32).reshape(-1, 1, 2)
+    if len(points) == 1:
+        cv2.circle(mask, tuple(points[0]), radius, color, -1)
+    else:
+        cv2.polylines(mask, [pts], False, color, thickness=2 * radius + 1)
+    h, w = mask.shape[:2]
+    r = radius + 1
+    xs, ys = pts[:, 0, 0], pts[:, 0, 1]
+    return (
+        max(0, int(xs.min()) - r), max(0, int(ys.min()) - r),
+        min(w, int(xs.max()) + r + 1), min(h, int(ys.max()) + r + 1)
+    )
+
+
+class StrokeRasterizer:
+    # Collects pointer samples for the current stroke and hands them to
+    # on_flush at most once per frame tick. Each batch starts with the last
+    # point of the previous one, so the drawn segments stay connected however
+    # fast the pointer moves.
+    def __init__(self, root, on_flush, frame_ms=FRAME_MS):
+        self.root = root
+        self.on_flush = on_flush
+        self.frame_ms = frame_ms
+        self.samples = []
+        self.last = None
+        self.tick = None
+
+    def begin(self, point):
+        self.cancel()
+        self.last = None
+        self.add(point)
+
+    def add(self, point):
+        if self.samples and self.samples[-1] == point:
+            return
+        self.samples.append(point)
+        if self.tick is None:
+            self.tick = self.root.after(self.frame_ms, self.flush)
+
+    def end(self):
+        self.flush()
+        self.last = None
+
+    def cancel(self):
+        if self.tick is not None:
+            self.root.after_cancel(self.tick)
+            self.tick = None
+        self.samples = []
+
+    def flush(self):
+        if self.tick is not None:
+            self.root.after_cancel(self.tick)
+            self.tick = None
+        if not self.samples:
+            return
+        points = self.samples if self.last is None else [self.last] + self.samples
+        self.last = self.samples[-1]
+        self.samples = []
+        self.on_flush(points)
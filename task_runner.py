@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LatestTaskRunner:
+    # Runs one background job at a time for a Tk app. Submitting while a job
+    # is running replaces whatever was waiting, and results of jobs that have
+    # been superseded are dropped instead of being delivered. Completion is
+    # polled from the Tk event loop so callbacks always run on the UI thread.
+    POLL_MS = 15
+
+    def __init__(self, root, on_busy=None):
+        self.root = root
+        self.on_busy = on_busy
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.generation = 0
+        self.pending = None
+        self.running = None
+        self.idle_callbacks = []
+
+    @property
+    def busy(self):
+        return self.running is not None or self.pending is not None
+
+    def submit(self, fn, *args, on_done=None, on_error=None):
+        self.generation += 1
+        self.pending = (self.generation, fn, args, on_done, on_error)
+        if self.running is None:
+            self._start_pending()
+        return self.generation
+
+    def cancel(self):
+        # cv2 calls cannot be interrupted, so in-flight work is simply
+        # orphaned and its result discarded when it lands
+        self.generation += 1
+        self.pending = None
+        if self.running is None:
+            self._notify_busy()
+
+    def when_idle(self, fn):
+        # Calls fn on the UI thread once no job is running, cancelled ones
+        # included, e.g. to free what an orphaned job may still be reading
+        if self.running is None:
+            fn()
+        else:
+            self.idle_callbacks.append(fn)
+
+    def is_current(self, generation):
+        return generation == self.generation
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+    def _start_pending(self):
+        job = self.pending
+        self.pending = None
+        future = self.executor.submit(job[1], *job[2])
+        self.running = (job, future)
+        self._notify_busy()
+        self.root.after(self.POLL_MS, self._poll)
+
+    def _poll(self):
+        job, future = self.running
+        if not future.done():
+            self.root.after(self.POLL_MS, self._poll)
+            return
+
+        self.running = None
+        callbacks, self.idle_callbacks = self.idle_callbacks, []
+        for fn in callbacks:
+            fn()
+        if self.pending is not None:
+            self._start_pending()
+        else:
+            self._notify_busy()
+
+        generation, _, _, on_done, on_error = job
+        if generation != self.generation:
+            return
+        error = future.exception()
+        if error is not None:
+            if on_error is not None:
+                on_error(error)
+        elif on_done is not None:
+            on_done(future.result())
+
+    def _notify_busy(self):
+        if self.on_busy is not None:
+            self.on_busy(self.busy)
+
+
+class OrderedTaskRunner:
+    # Runs background jobs one at a time in submission order and delivers
+    # every result, unlike LatestTaskRunner. Meant for work that must not be
+    # dropped, such as writing files.
+    POLL_MS = 50
+
+    def __init__(self, root, on_busy=None):
+        self.root = root
+        self.on_busy = on_busy
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.jobs = []
+
+    @property
+    def busy(self):
+        return bool(self.jobs)
+
+    def submit(self, fn, *args, on_done=None, on_error=None):
+        future = self.executor.submit(fn, *args)
+        self.jobs.append((future, on_done, on_error))
+        if len(self.jobs) == 1:
+            if self.on_busy is not None:
+                self.on_busy(True)
+            self.root.after(self.POLL_MS, self._poll)
+
+    def shutdown(self):
+        # Queued jobs still run to completion
+        self.executor.shutdown(wait=False)
+
+    def _poll(self):
+        while self.jobs and self.jobs[0][0].done():
+            future, on_done, on_error = self.jobs.pop(0)
+            error = future.exception()
+            if error is not None:
+                if on_error is not None:
+                    on_error(error)
+            elif on_done is not None:
+                on_done(future.result())
+        if self.jobs:
+            self.root.after(self.POLL_MS, self._poll)
+        elif self.on_busy is not None:
+            self.on_busy(False)
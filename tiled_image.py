@@ -0,0 +1,280 @@
+import atexit
+import os
+import struct
+import tempfile
+import weakref
+import zlib
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+
+from inpaint_engine import get_engine
+
+TILE_SIZE = 1024
+
+# Images at least this large are opened with the tiled backend
+TILED_MIN_PIXELS = 64 * 1024 * 1024
+
+# A group of adjacent masked tiles is inpainted as one window unless the
+# window would exceed this many pixels; past that, tiles are processed one
+# at a time with a halo so memory stays bounded
+MAX_WINDOW_PIXELS = 16 * 1024 * 1024
+
+
+def remove_scratch(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # Still mapped somewhere (Windows cannot remove it then); retried
+        # at exit
+        atexit.register(remove_quietly, path)
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class TiledImage:
+    # Pixels live in a memory-mapped scratch file, so only the pages that are
+    # actually touched occupy RAM. `pixels` is a regular ndarray (np.memmap)
+    # and can be handed to anything that takes an image array.
+    #
+    # Only the pixels are tiled. Decoding still holds the full frame in RAM
+    # once while loading, and the GUI's mask and applied-mask arrays are
+    # full-resolution 8-bit frames (a third of the image's size).
+    def __init__(self, shape, dtype=np.uint8, tile_size=TILE_SIZE, directory=None):
+        fd, self.path = tempfile.mkstemp(suffix=".pixels", dir=directory)
+        os.close(fd)
+        self.pixels = np.memmap(self.path, dtype=dtype, mode="w+", shape=tuple(shape))
+        self.tile_size = tile_size
+        # The scratch file goes with the last array viewing the mapping, so
+        # a worker still reading a closed image keeps valid pixels
+        weakref.finalize(self.pixels, remove_scratch, self.path)
+
+    @classmethod
+    def from_array(cls, array, tile_size=TILE_SIZE, directory=None):
+        tiled = cls(array.shape, array.dtype, tile_size, directory)
+        tiled.copy_from(array)
+        return tiled
+
+    @classmethod
+    def load(cls, path, tile_size=TILE_SIZE, directory=None):
+        # OpenCV can only decode a whole frame, so the decoded image exists
+        # once in RAM; it is moved to the scratch file in bands as RGB and
+        # released before this returns
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError("Unsupported image format")
+        if img.ndim == 2:
+            shape = img.shape + (3,)
+        else:
+            shape = img.shape[:2] + (3,)
+        tiled = cls(shape, img.dtype, tile_size, directory)
+        for y0, y1 in tiled.bands():
+            band = img[y0:y1]
+            if band.ndim == 2:
+                tiled.pixels[y0:y1] = cv2.cvtColor(band, cv2.COLOR_GRAY2RGB)
+            elif band.shape[2] == 4:
+                tiled.pixels[y0:y1] = cv2.cvtColor(band, cv2.COLOR_BGRA2RGB)
+            else:
+                tiled.pixels[y0:y1] = cv2.cvtColor(band, cv2.COLOR_BGR2RGB)
+        return tiled
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+    def bands(self):
+        for y in range(0, self.shape[0], self.tile_size):
+            yield y, min(self.shape[0], y + self.tile_size)
+
+    def copy_from(self, source, rect=None):
+        if rect is None:
+            for y0, y1 in self.bands():
+                self.pixels[y0:y1] = source[y0:y1]
+        else:
+            x0, y0, x1, y1 = rect
+            self.pixels[y0:y1, x0:x1] = source[y0:y1, x0:x1]
+
+    def save(self, path):
+        if path.lower().endswith(".png"):
+            write_png(path, self.pixels, self.tile_size)
+            return
+        # Other encoders in OpenCV and PIL need the whole frame at once
+        img = self.pixels
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        if not cv2.imwrite(path, img):
+            raise ValueError(f"Could not write {path}")
+
+    def close(self):
+        # Drops this image's reference; numpy unmaps once no view is left
+        self.pixels = None
+
+
+def masked_tiles(mask, tile_size):
+    # Boolean grid with one cell per tile that contains any masked pixel
+    h, w = mask.shape[:2]
+    rows, cols = -(-h // tile_size), -(-w // tile_size)
+    grid = np.zeros((rows, cols), dtype=bool)
+    for r in range(rows):
+        band = mask[r * tile_size:(r + 1) * tile_size]
+        if not band.any():
+            continue
+        cols_any = band.any(axis=0)
+        for c in range(cols):
+            grid[r, c] = cols_any[c * tile_size:(c + 1) * tile_size].any()
+    return grid
+
+
+def inpaint_tiles(src, mask, radius, engine, tile_size=TILE_SIZE, max_window=MAX_WINDOW_PIXELS):
+    # Inpaints src under mask touching only tiles that contain masked pixels,
+    # plus a halo around them. src is only read; the result comes back as
+    # (rect, pixels) patches which, pasted over src, give the inpainted image.
+    h, w = mask.shape[:2]
+    grid = masked_tiles(mask, tile_size)
+    if not grid.any():
+        return []
+
+    engine = get_engine(engine)
+    patches = []
+
+    # Masked tiles that touch (8-connected) form one group, inpainted in a
+    # window of its tiles plus the engine's halo. The halo can be wider
+    # than the gap between groups (PatchMatch's is), so groups whose
+    # windows intersect are merged: otherwise a window would fill another
+    # group's masked pixels from a cut-off context and its patch would be
+    # pasted over that group's result.
+    count, labels = cv2.connectedComponents(grid.astype(np.uint8), connectivity=8)
+    groups = []
+    for label in range(1, count):
+        rows, cols = np.nonzero(labels == label)
+        groups.append((rows, cols, group_window(engine, radius, rows, cols, tile_size, w, h)))
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                a, b = groups[i][2], groups[j][2]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rows = np.concatenate((groups[i][0], groups[j][0]))
+                    cols = np.concatenate((groups[i][1], groups[j][1]))
+                    groups[i] = (rows, cols, group_window(engine, radius, rows, cols, tile_size, w, h))
+                    del groups[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    for rows, cols, (x0, y0, x1, y1) in groups:
+        if (x1 - x0) * (y1 - y0) <= max_window:
+            pixels = engine.inpaint(
+                np.ascontiguousarray(src[y0:y1, x0:x1]),
+                np.ascontiguousarray(mask[y0:y1, x0:x1]),
+                radius
+            )
+            patches.append(((x0, y0, x1, y1), pixels))
+        else:
+            patches.extend(inpaint_group_by_tile(src, mask, radius, engine, tile_size, rows, cols))
+    return patches
+
+
+def group_window(engine, radius, rows, cols, tile_size, w, h):
+    # The tiles at rows, cols plus the engine's halo, clipped to the image
+    margin = engine.halo(radius, (cols.min() * tile_size, rows.min() * tile_size,
+                                  (cols.max() + 1) * tile_size, (rows.max() + 1) * tile_size))
+    return (max(0, cols.min() * tile_size - margin), max(0, rows.min() * tile_size - margin),
+            min(w, (cols.max() + 1) * tile_size + margin), min(h, (rows.max() + 1) * tile_size + margin))
+
+
+def inpaint_group_by_tile(src, mask, radius, engine, tile_size, rows, cols):
+    # Fallback for very large masks. Each tile is inpainted in a window with a
+    # quarter-tile halo and only its own pixels are kept. Tiles already done
+    # count as known pixels in later windows, so the fill continues across
+    # tile borders instead of leaving seams.
+    h, w = mask.shape[:2]
+    halo = max(engine.halo(radius, (0, 0, tile_size, tile_size)), tile_size // 4)
+    done = {}
+    for r, c in sorted(zip(rows.tolist(), cols.tolist())):
+        tx0, ty0 = c * tile_size, r * tile_size
+        tx1, ty1 = min(w, tx0 + tile_size), min(h, ty0 + tile_size)
+        x0, y0 = max(0, tx0 - halo), max(0, ty0 - halo)
+        x1, y1 = min(w, tx1 + halo), min(h, ty1 + halo)
+        window = src[y0:y1, x0:x1].copy()
+        window_mask = mask[y0:y1, x0:x1].copy()
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                patch = done.get((r + dr, c + dc))
+                if patch is None:
+                    continue
+                (px0, py0, px1, py1), pixels = patch
+                ix0, iy0 = max(px0, x0), max(py0, y0)
+                ix1, iy1 = min(px1, x1), min(py1, y1)
+                if ix0 >= ix1 or iy0 >= iy1:
+                    continue
+                window[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = pixels[iy0 - py0:iy1 - py0, ix0 - px0:ix1 - px0]
+                window_mask[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = 0
+        result = engine.inpaint(window, window_mask, radius)
+        done[(r, c)] = ((tx0, ty0, tx1, ty1), result[ty0 - y0:ty1 - y0, tx0 - x0:tx1 - x0].copy())
+    return list(done.values())
+
+
+PNG_FILTERS = {"none": 0, "sub": 1, "up": 2}
+
+# zlib strategies; OpenCV's IMWRITE_PNG_STRATEGY_* values are the same
+PNG_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY, "filtered": zlib.Z_FILTERED, "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE, "fixed": zlib.Z_FIXED,
+}
+
+
+def write_png(path, pixels, rows_per_band=TILE_SIZE, level=6, filter="sub", bgr=False, strategy="default"):
+    # Streams a PNG out band by band so the encoder never needs the whole
+    # frame in memory. Every scanline uses the same filter; bgr=True swaps
+    # each band to RGB on the way out. path may also be a binary file object.
+    h, w = pixels.shape[:2]
+    channels = 1 if pixels.ndim == 2 else pixels.shape[2]
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+    if pixels.dtype != np.uint8:
+        raise ValueError("Only 8-bit images can be streamed to PNG")
+    if filter not in PNG_FILTERS:
+        raise ValueError(f"Unknown PNG filter: {filter}")
+    if strategy not in PNG_STRATEGIES:
+        raise ValueError(f"Unknown PNG strategy: {strategy}")
+
+    def chunk(f, tag, data):
+        f.write(struct.pack(">I", len(data)))
+        f.write(tag)
+        f.write(data)
+        f.write(struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, PNG_STRATEGIES[strategy])
+    previous = np.zeros(w * channels, dtype=np.uint8)
+    with (open(path, "wb") if isinstance(path, (str, os.PathLike)) else nullcontext(path)) as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        chunk(f, b"IHDR", struct.pack(">IIBBBBB", w, h, 8, color_type, 0, 0, 0))
+        for y in range(0, h, rows_per_band):
+            band = pixels[y:y + rows_per_band]
+            if bgr and channels >= 3:
+                band = band[..., [2, 1, 0] + list(range(3, channels))]
+            rows = np.ascontiguousarray(band).reshape(-1, w * channels)
+            lines = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+            lines[:, 0] = PNG_FILTERS[filter]
+            if filter == "none":
+                lines[:, 1:] = rows
+            elif filter == "sub":
+                lines[:, 1:channels + 1] = rows[:, :channels]
+                np.subtract(rows[:, channels:], rows[:, :-channels], out=lines[:, channels + 1:])
+            else:
+                np.subtract(rows[:1], previous, out=lines[:1, 1:])
+                np.subtract(rows[1:], rows[:-1], out=lines[1:, 1:])
+                previous = rows[-1].copy()
+            data = compressor.compress(lines.tobytes())
+            if data:
+                chunk(f, b"IDAT", data)
+        chunk(f, b"IDAT", compressor.flush())
+        chunk(f, b"IEND", b"")
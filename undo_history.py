@@ -0,0 +1,207 @@
+import tempfile
+import zlib
+
+import numpy as np
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+# The newest steps on each stack stay as plain arrays so undo/redo right
+# after an edit doesn't pay for decompression
+HOT_STEPS = 2
+
+# Dead bytes the spill file may hold before the live patches are copied to
+# a fresh one, so small histories aren't rewritten over and over
+SPILL_SLACK = 32 * 1024 * 1024
+
+
+class RegionPatch:
+    # The pixels of one rectangle of an image, held as an array, as zlib
+    # bytes, or as a (offset, length) reference into the history's spill file
+    def __init__(self, array, rect):
+        x0, y0, x1, y1 = rect
+        self.rect = rect
+        self.pixels = array[y0:y1, x0:x1].copy()
+        self.shape = self.pixels.shape
+        self.dtype = self.pixels.dtype
+        self.data = None
+        self.location = None
+
+    @property
+    def nbytes(self):
+        if self.pixels is not None:
+            return self.pixels.nbytes
+        if self.data is not None:
+            return len(self.data)
+        return 0
+
+    def compress(self):
+        if self.pixels is not None:
+            self.data = zlib.compress(self.pixels.tobytes(), 1)
+            self.pixels = None
+
+    def spill(self, file):
+        self.compress()
+        if self.data is not None:
+            file.seek(0, 2)
+            self.location = (file.tell(), len(self.data))
+            file.write(self.data)
+            self.data = None
+
+    def move(self, source, target):
+        # Copies the spilled bytes from source to the end of target
+        offset, length = self.location
+        source.seek(offset)
+        data = source.read(length)
+        target.seek(0, 2)
+        self.location = (target.tell(), length)
+        target.write(data)
+
+    def load(self, file):
+        if self.pixels is not None:
+            return self.pixels
+        data = self.data
+        if data is None:
+            offset, length = self.location
+            file.seek(offset)
+            data = file.read(length)
+        return np.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape(self.shape)
+
+    def apply(self, array, file):
+        x0, y0, x1, y1 = self.rect
+        array[y0:y1, x0:x1] = self.load(file)
+
+
+class UndoHistory:
+    # Undo/redo for an image and its mask that stores only the rectangles an
+    # edit touches. Older steps are zlib-compressed and, once the history
+    # holds more than `budget` bytes, moved to an anonymous temporary file.
+    #
+    # The mask's previous contents are taken from a baseline copy that the
+    # history keeps in sync, so callers can record a step after drawing on
+    # the mask. Images must be recorded before they change.
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.undo_stack = []
+        self.redo_stack = []
+        self.baseline_mask = None
+        self.spill_file = None
+
+    @property
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    @property
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    @property
+    def last_meta(self):
+        # Meta of the step undo() would undo next
+        return self.undo_stack[-1]['meta'] if self.undo_stack else None
+
+    @property
+    def nbytes(self):
+        return sum(
+            patch.nbytes
+            for step in self.undo_stack + self.redo_stack
+            for patch in (step['image'], step['mask']) if patch is not None
+        )
+
+    def reset(self, mask_shape):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        # np.zeros maps untouched pages lazily, so the baseline only costs
+        # memory where the mask has been drawn on
+        self.baseline_mask = np.zeros(mask_shape, dtype=np.uint8)
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def push(self, image, image_rect, mask, mask_rect, meta=None):
+        # image_rect: where image is about to change; mask_rect: where mask
+        # has changed since the last step. Either may be None. mask can also
+        # be just its pixels in mask_rect, taken when the edit was made, if
+        # the mask has been drawn on since.
+        step = {
+            'image': RegionPatch(image, image_rect) if image_rect else None,
+            'mask': RegionPatch(self.baseline_mask, mask_rect) if mask_rect else None,
+            'meta': meta,
+        }
+        if mask_rect:
+            x0, y0, x1, y1 = mask_rect
+            if mask.shape[:2] == self.baseline_mask.shape[:2]:
+                mask = mask[y0:y1, x0:x1]
+            self.baseline_mask[y0:y1, x0:x1] = mask
+        self.undo_stack.append(step)
+        self.redo_stack.clear()
+        self.enforce_budget()
+
+    def undo(self, image, mask, meta=None):
+        # Restores image and mask in place and returns the meta recorded
+        # with the step. meta goes with the step on the redo stack; by
+        # default it keeps its own.
+        return self.swap(self.undo_stack, self.redo_stack, image, mask, meta)
+
+    def redo(self, image, mask, meta=None):
+        return self.swap(self.redo_stack, self.undo_stack, image, mask, meta)
+
+    def swap(self, source, target, image, mask, meta):
+        step = source.pop()
+        image_patch, mask_patch = step['image'], step['mask']
+        target.append({
+            'image': RegionPatch(image, image_patch.rect) if image_patch else None,
+            'mask': RegionPatch(mask, mask_patch.rect) if mask_patch else None,
+            'meta': step['meta'] if meta is None else meta,
+        })
+        if image_patch is not None:
+            image_patch.apply(image, self.spill_file)
+        if mask_patch is not None:
+            mask_patch.apply(mask, self.spill_file)
+            mask_patch.apply(self.baseline_mask, self.spill_file)
+        self.enforce_budget()
+        return step['meta']
+
+    def enforce_budget(self):
+        cold = self.undo_stack[:-HOT_STEPS] + self.redo_stack[:-HOT_STEPS]
+        for step in cold:
+            for patch in (step['image'], step['mask']):
+                if patch is not None:
+                    patch.compress()
+
+        self.compact_spill()
+        total = self.nbytes
+        if total <= self.budget:
+            return
+        # Oldest steps first: the bottom of each stack is furthest from the
+        # current state
+        for step in cold:
+            for patch in (step['image'], step['mask']):
+                if patch is None or patch.location is not None:
+                    continue
+                if self.spill_file is None:
+                    self.spill_file = tempfile.TemporaryFile()
+                total -= patch.nbytes
+                patch.spill(self.spill_file)
+            if total <= self.budget:
+                break
+
+    def compact_spill(self):
+        # Spilled patches of steps that left the stacks (undone, redone, or
+        # cleared by a new edit) leave dead bytes in the spill file. Once
+        # those outweigh the live ones, the live patches move to a new file.
+        if self.spill_file is None:
+            return
+        spilled = [
+            patch
+            for step in self.undo_stack + self.redo_stack
+            for patch in (step['image'], step['mask']) if patch is not None and patch.location is not None
+        ]
+        live = sum(patch.location[1] for patch in spilled)
+        if self.spill_file.seek(0, 2) - live <= max(live, SPILL_SLACK):
+            return
+        old, self.spill_file = self.spill_file, None
+        if spilled:
+            self.spill_file = tempfile.TemporaryFile()
+            for patch in spilled:
+                patch.move(old, self.spill_file)
+        old.close()
@@ -0,0 +1,115 @@
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from batch_remove import load_mask, parse_roi
+from inpaint_engine import ENGINES, crop_window, get_engine, rect_mask
+
+# Per-worker state, set once by init_worker
+_settings = None
+
+
+def init_worker(settings):
+    global _settings
+    cv2.setNumThreads(1)
+    _settings = settings
+
+
+def inpaint_crop(crop):
+    # The mask is the same for every frame, so workers only ever see the
+    # inpainting window of each frame rather than the full picture
+    engine = get_engine(_settings["engine"])
+    return engine.inpaint(crop, _settings["mask"], _settings["radius"])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Remove a static watermark from a video.")
+    parser.add_argument("input", help="input video file")
+    parser.add_argument("-o", "--output", required=True, help="output video file")
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument("--roi", type=parse_roi, help="watermark rectangle as x,y,w,h")
+    region.add_argument("--mask", help="mask image; non-zero pixels are inpainted")
+    parser.add_argument("--algorithm", choices=sorted(ENGINES), default="telea")
+    parser.add_argument("--radius", type=float, default=3)
+    parser.add_argument("--fourcc", default="mp4v", help="output codec (default: %(default)s)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--queue", type=int, default=0,
+                        help="frames in flight; bounds memory (default: 2 per worker)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    capture = cv2.VideoCapture(args.input)
+    if not capture.isOpened():
+        print(f"Error: Could not open video {args.input}")
+        return 1
+
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+
+    if args.mask:
+        mask = load_mask(args.mask)
+        if mask.shape != (height, width):
+            print(f"Error: mask is {mask.shape[1]}x{mask.shape[0]}, video is {width}x{height}")
+            return 1
+    else:
+        mask = rect_mask((height, width), args.roi)
+
+    window = crop_window(mask, args.radius, args.algorithm)
+    if window is None:
+        print("Error: Mask is empty")
+        return 1
+    x0, y0, x1, y1 = window
+
+    writer = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*args.fourcc), fps, (width, height))
+    if not writer.isOpened():
+        print(f"Error: Could not open {args.output} for writing")
+        return 1
+
+    settings = {
+        "mask": np.ascontiguousarray(mask[y0:y1, x0:x1]),
+        "radius": args.radius,
+        "engine": args.algorithm,
+    }
+    workers = max(1, args.workers or 1)
+    limit = args.queue or 2 * workers
+
+    # Frames wait in a bounded FIFO until their crop comes back, so memory
+    # stays at `limit` frames however long the clip is, and output order is
+    # the decode order
+    frames = 0
+    in_flight = deque()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(settings,)) as pool:
+        while True:
+            ok, frame = capture.read()
+            if ok:
+                crop = np.ascontiguousarray(frame[y0:y1, x0:x1])
+                in_flight.append((frame, pool.submit(inpaint_crop, crop)))
+            if in_flight and (not ok or len(in_flight) >= limit):
+                frame, future = in_flight.popleft()
+                frame[y0:y1, x0:x1] = future.result()
+                writer.write(frame)
+                frames += 1
+            elif not ok:
+                break
+
+    capture.release()
+    writer.release()
+    elapsed = time.perf_counter() - start
+    print(f"Processed {frames} frames in {elapsed:.2f}s ({frames / elapsed:.1f} frames/s, {workers} workers)")
+    print("Note: audio is not copied; mux it back in with your usual tool if needed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+import tkinter as tk
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+
+from inpaint_engine import union_rect
+
+MASK_COLOR = (255, 0, 0)
+
+
+class ViewportRenderer:
+    # Draws the part of an image that is visible in a scrolled canvas into a
+    # single persistent canvas item. Zoomed-out views sample from cached
+    # 2^k-downscaled levels, so each redraw resizes at most a viewport's
+    # worth of pixels whatever the image size.
+    def __init__(self, canvas, band_rows=1024, profiler=None):
+        self.canvas = canvas
+        self.band_rows = band_rows
+        # Optional StageProfiler that draws are timed into
+        self.profiler = profiler
+        self.image = None
+        self.mask = None
+        self.zoom = 1.0
+        self.levels = {}
+        # Full-resolution shape, and while only a reduced decode is
+        # available, the factor it was reduced by (see set_proxy)
+        self.shape = None
+        self.proxy_factor = None
+        # Optional (rect, pixels) shown over the image, e.g. a quick
+        # inpainting preview while the full-resolution result is computed
+        self.preview = None
+        self.item = None
+        self.photo = None
+        self.scheduled = None
+        # What the last full draw put on screen: the viewport before the mask
+        # overlay and the mapping from view pixels back to the image
+        self.base_view = None
+        self.view_geometry = None
+        # Image-space rectangle where only the mask changed since then
+        self.mask_dirty = None
+        self.mask_scheduled = None
+
+    def set_image(self, image, changed_rect=None):
+        # changed_rect limits the cache refresh to the part that changed;
+        # without it every cached level is dropped
+        same_shape = self.image is not None and self.image.shape == image.shape
+        self.image = image
+        self.shape = image.shape
+        self.proxy_factor = None
+        if changed_rect is None or not same_shape:
+            self.levels = {}
+            self.preview = None
+            return
+        # A new result replaces any preview that was standing in for it
+        if self.preview is not None:
+            changed_rect = union_rect(changed_rect, self.preview[0])
+            self.preview = None
+        for factor in self.levels:
+            self.refresh_level(factor, changed_rect)
+
+    def set_proxy(self, pixels, factor, shape):
+        # Stands in for an image of `shape` that is still being decoded:
+        # pixels is that image reduced by `factor` and is drawn as that
+        # pyramid level at every zoom until set_image() replaces it
+        self.image = None
+        self.shape = shape
+        self.proxy_factor = factor
+        self.levels = {factor: pixels}
+        self.preview = None
+
+    def set_preview(self, rect, pixels):
+        self.clear_preview()
+        self.preview = (rect, pixels)
+        for factor in self.levels:
+            self.refresh_level(factor, rect)
+        self.render()
+
+    def clear_preview(self):
+        if self.preview is None:
+            return
+        rect = self.preview[0]
+        self.preview = None
+        for factor in self.levels:
+            self.refresh_level(factor, rect)
+        self.render()
+
+    def read(self, x0, y0, x1, y1):
+        # Image pixels in the rectangle with the preview pasted over them
+        region = self.image[y0:y1, x0:x1]
+        if self.preview is None:
+            return region
+        (px0, py0, px1, py1), pixels = self.preview
+        ix0, iy0 = max(x0, px0), max(y0, py0)
+        ix1, iy1 = min(x1, px1), min(y1, py1)
+        if ix0 >= ix1 or iy0 >= iy1:
+            return region
+        region = np.array(region)
+        region[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = pixels[iy0 - py0:iy1 - py0, ix0 - px0:ix1 - px0]
+        return region
+
+    def set_mask(self, mask):
+        self.mask = mask
+
+    def set_zoom(self, zoom):
+        self.zoom = zoom
+
+    def clear(self):
+        self.image = None
+        self.mask = None
+        self.levels = {}
+        self.shape = None
+        self.proxy_factor = None
+        self.preview = None
+        if self.item is not None:
+            self.canvas.delete(self.item)
+        self.item = None
+        self.photo = None
+        self.base_view = None
+        self.view_geometry = None
+
+    def level(self, factor):
+        # Level k is the image block-averaged by factor = 2^k, built band by
+        # band so a memory-mapped source is never loaded all at once
+        if factor == 1:
+            return self.image
+        level = self.levels.get(factor)
+        if level is None:
+            h, w = self.image.shape[:2]
+            level = np.empty((h // factor, w // factor) + self.image.shape[2:], dtype=self.image.dtype)
+            self.levels[factor] = level
+            self.refresh_level(factor, (0, 0, w, h))
+        return level
+
+    def refresh_level(self, factor, rect):
+        level = self.levels[factor]
+        x0, y0, x1, y1 = rect
+        lx0, ly0 = x0 // factor, y0 // factor
+        lx1 = min(level.shape[1], -(-x1 // factor))
+        ly1 = min(level.shape[0], -(-y1 // factor))
+        if lx0 >= lx1 or ly0 >= ly1:
+            return
+        step = max(1, self.band_rows // factor)
+        for by in range(ly0, ly1, step):
+            by1 = min(ly1, by + step)
+            src = self.read(lx0 * factor, by * factor, lx1 * factor, by1 * factor)
+            level[by:by1, lx0:lx1] = cv2.resize(src, (lx1 - lx0, by1 - by), interpolation=cv2.INTER_AREA)
+
+    def render(self):
+        # Coalesces redraw requests into one draw per idle cycle
+        if self.scheduled is None:
+            self.scheduled = self.canvas.after_idle(self.draw)
+
+    def render_mask(self, rect):
+        # Cheaper than render() when only the mask changed inside rect (image
+        # coordinates): just that part of the on-screen view is re-blended
+        self.mask_dirty = union_rect(self.mask_dirty, rect)
+        if self.mask_scheduled is None and self.scheduled is None:
+            self.mask_scheduled = self.canvas.after_idle(self.draw_mask)
+
+    def stage(self, name):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.stage(name)
+
+    def viewport(self):
+        x0 = int(self.canvas.canvasx(0))
+        y0 = int(self.canvas.canvasy(0))
+        return x0, y0, x0 + max(1, self.canvas.winfo_width()), y0 + max(1, self.canvas.winfo_height())
+
+    def draw(self):
+        self.scheduled = None
+        self.mask_dirty = None
+        if self.shape is None:
+            return
+
+        h, w = self.shape[:2]
+        zoom = self.zoom
+        self.canvas.config(scrollregion=(0, 0, int(w * zoom), int(h * zoom)))
+
+        if self.proxy_factor is not None:
+            factor = self.proxy_factor
+        else:
+            factor = 1
+            while factor * 2 * zoom <= 1 and min(h, w) // (factor * 2) >= 1:
+                factor *= 2
+        with self.stage("pyramid"):
+            level = self.level(factor)
+        scale = zoom * factor
+        lh, lw = level.shape[:2]
+
+        # Visible part of the canvas, in level pixels
+        vx0, vy0, vx1, vy1 = self.viewport()
+        sx0 = max(0, int(vx0 / scale))
+        sy0 = max(0, int(vy0 / scale))
+        sx1 = min(lw, int(np.ceil(vx1 / scale)) + 1)
+        sy1 = min(lh, int(np.ceil(vy1 / scale)) + 1)
+        if sx0 >= sx1 or sy0 >= sy1:
+            return
+
+        out_w = max(1, int(round((sx1 - sx0) * scale)))
+        out_h = max(1, int(round((sy1 - sy0) * scale)))
+        with self.stage("resize"):
+            crop = self.read(sx0, sy0, sx1, sy1) if factor == 1 else level[sy0:sy1, sx0:sx1]
+            if (out_w, out_h) == (sx1 - sx0, sy1 - sy0):
+                view = np.array(crop)
+            else:
+                interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+                view = cv2.resize(crop, (out_w, out_h), interpolation=interpolation)
+
+        # View pixel (i, j) shows image pixel (ys[i], xs[j])
+        xs = ((sx0 + (np.arange(out_w) + 0.5) * (sx1 - sx0) / out_w) * factor).astype(np.intp)
+        ys = ((sy0 + (np.arange(out_h) + 0.5) * (sy1 - sy0) / out_h) * factor).astype(np.intp)
+        self.view_geometry = (np.minimum(xs, w - 1), np.minimum(ys, h - 1))
+        self.base_view = view.copy()
+        with self.stage("mask"):
+            self.blend_mask(view, 0, 0)
+
+        with self.stage("photo"):
+            self.show(view, int(round(sx0 * scale)), int(round(sy0 * scale)))
+
+    def blend_mask(self, view, ox, oy):
+        # Overlays the mask on a block of the view whose top-left is view
+        # pixel (ox, oy)
+        if self.mask is None:
+            return
+        xs, ys = self.view_geometry
+        rows = ys[oy:oy + view.shape[0]]
+        cols = xs[ox:ox + view.shape[1]]
+        view[self.mask[np.ix_(rows, cols)] == 255] = MASK_COLOR
+
+    def draw_mask(self):
+        self.mask_scheduled = None
+        rect, self.mask_dirty = self.mask_dirty, None
+        if rect is None or self.base_view is None or self.photo is None:
+            return
+
+        # Image rectangle -> block of view pixels that sample from it
+        xs, ys = self.view_geometry
+        x0, y0, x1, y1 = rect
+        ox0, ox1 = np.searchsorted(xs, x0), np.searchsorted(xs, x1)
+        oy0, oy1 = np.searchsorted(ys, y0), np.searchsorted(ys, y1)
+        if ox0 >= ox1 or oy0 >= oy1:
+            return
+
+        block = self.base_view[oy0:oy1, ox0:ox1].copy()
+        self.blend_mask(block, ox0, oy0)
+        patch = ImageTk.PhotoImage(Image.fromarray(block))
+        self.photo.tk.call(str(self.photo), "copy", str(patch), "-to", int(ox0), int(oy0))
+
+    def show(self, view, x, y):
+        img = Image.fromarray(view)
+        if self.photo is not None and (self.photo.width(), self.photo.height()) == img.size:
+            self.photo.paste(img)
+        else:
+            self.photo = ImageTk.PhotoImage(img)
+        if self.item is None:
+            self.item = self.canvas.create_image(x, y, anchor=tk.NW, image=self.photo)
+        else:
+            self.canvas.itemconfig(self.item, image=self.photo)
+            self.canvas.coords(self.item, x, y)
@@ -4,6 +4,65 @@ from PIL import Image, ImageTk, ImageDraw, ImageFilter
 import cv2
 import numpy as np
 import os
+from inpaint_engine import ENGINES, get_engine, inpaint_preview, union_rect
+from engine_select import EngineSelector
+from inpaint_cache import InpaintCache, cache_key
+from image_buffer import ENCODE_DEFAULTS, ImageBuffer
+from shared_frames import SharedFrames
+from stage_timing import StageProfiler
+from task_runner import LatestTaskRunner, OrderedTaskRunner
+from tiled_image import TILED_MIN_PIXELS, TiledImage, inpaint_tiles
+from undo_history import UndoHistory
+from viewport_renderer import ViewportRenderer
+from stroke_input import StrokeRasterizer, draw_stroke
+
+# Steps whose window is larger than PREVIEW_MIN_PIXELS show a downscaled
+# inpaint of about PREVIEW_PIXELS first, so its cost stays fixed however
+# large the mask. It is computed on its own thread with the cheapest
+# engine and shown until the full-resolution result replaces it.
+PREVIEW_PIXELS = 256 * 256
+PREVIEW_MIN_PIXELS = 4 * PREVIEW_PIXELS
+PREVIEW_ENGINE = "telea"
+
+# Radius slider changes settle this long before the last step is redone
+RADIUS_DEBOUNCE_MS = 150
+
+# JPEGs at least this large open as a reduced decode sized to the canvas,
+# while the full-resolution decode runs in the background
+PROXY_MIN_PIXELS = 8 * 1024 * 1024
+PROXY_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# EXIF orientation is ignored so decodes agree with PIL's header size
+LOAD_FLAGS = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+
+def inpaint_shared(frames, window, mask, radius, engine, cache):
+    # Runs on the inpaint runner's thread. The window is inpainted in one
+    # go by the worker process and comes back as the (rect, pixels)
+    # patches that inpaint_tiles returns for tiled images. The window is
+    # first copied out of the shared image: once a step is cancelled, undo
+    # or a newly opened image may write there while it still runs, and the
+    # cache key must describe exactly the pixels the worker reads.
+    x0, y0, x1, y1 = window
+    source = frames.stage("source", frames.frame("image")[y0:y1, x0:x1])
+    mask = frames.stage("mask", mask)
+    key = cache_key(source, mask, radius, get_engine(engine))
+    pixels = cache.get(key)
+    if pixels is None:
+        pixels = frames.inpaint(radius, engine)
+        cache.put(key, pixels)
+    return [((0, 0, x1 - x0, y1 - y0), pixels)]
+
+def encode_snapshot(buffer, path, options, snapshot=None):
+    # Runs on the save runner's thread; a tiled snapshot is removed once
+    # it has been written out
+    try:
+        return buffer.save(path, options)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
 
 class AdvancedWatermarkRemoverPro:
     def __init__(self, root):
@@ -13,22 +72,66 @@ class AdvancedWatermarkRemoverPro:
         self.setup_variables()
         self.create_ui()
         self.bind_events()
+        if not self.engine_selector.calibrated:
+            # Reference-machine estimates are used until then
+            self.update_status("Auto engine uses reference timings until calibrated (Edit > Calibrate Auto Engine)")
         
     def setup_variables(self):
-        self.history = []
-        self.undo_stack = []
-        self.redo_stack = []
+        self.history = UndoHistory()
+        # Times the stages of each operation for the status bar and, when
+        # enabled from the View menu, a trace file
+        self.profiler = StageProfiler(self.root, on_report=self.update_status)
+        self.trace_enabled = tk.BooleanVar(value=False)
+        # Edits are cumulative: each step inpaints only what the mask gained
+        # since the last one, on top of the current result. stroke_rect is
+        # where the mask has changed since the last applied step and
+        # inpaint_step the step being computed, if any.
+        self.stroke_rect = None
+        self.inpaint_step = None
         self.original_image = None
         self.processed_image = None
+        # Full-resolution shape, known before the pixels when a proxy is
+        # shown; inpainting asked for meanwhile waits for the full decode,
+        # as it does for a step that is still running
+        self.image_shape = None
+        self.inpaint_waiting = False
+        # Set for images opened with the memory-mapped tiled backend
+        self.original_tiles = None
+        self.processed_tiles = None
         self.mask = None
         self.zoom_level = 1.0
         self.selected_tool = "rectangle"
         self.brush_size = 10
         self.last_point = None
+        self.rect_item = None
+        self.stroke = StrokeRasterizer(self.root, self.draw_on_mask)
         self.inpaint_radius = 7
+        self.radius_job = None
+        # "auto" asks the selector for the fastest engine that is good
+        # enough for the current mask
+        self.engine_name = tk.StringVar(value="auto")
+        self.engine_selector = EngineSelector()
+        # Engine results by content, so redrawing a stroke after undoing it
+        # or going back to an earlier radius is a lookup
+        self.inpaint_cache = InpaintCache()
+        # processed_image lives in shared memory, and inpainting runs in a
+        # worker process that reads it there, so Tk never waits on the GIL
+        # for an engine call and no pixels are pickled
+        self.frames = SharedFrames()
+        self.frames.start()
         self.working_image = None
         self.display_image = None
         self.mask_preview = None
+        self.inpaint_runner = LatestTaskRunner(self.root, on_busy=self.on_inpaint_busy)
+        self.preview_runner = LatestTaskRunner(self.root)
+        self.load_runner = LatestTaskRunner(self.root)
+        self.calibration_runner = LatestTaskRunner(self.root)
+        # Saves encode in the background, in order, with per-format settings
+        self.save_runner = OrderedTaskRunner(self.root)
+        self.save_options = {fmt: dict(settings) for fmt, settings in ENCODE_DEFAULTS.items()}
+        # Tiled snapshots being copied on the save runner; edits wait for
+        # them, as they would for a running step
+        self.snapshots_pending = 0
 
     def create_ui(self):
         self.create_menu()
@@ -43,6 +146,7 @@ class AdvancedWatermarkRemoverPro:
         file_menu = tk.Menu(menubar, tearoff=0)
         file_menu.add_command(label="Open", command=self.open_image, accelerator="Ctrl+O")
         file_menu.add_command(label="Save", command=self.save_image, accelerator="Ctrl+S")
+        file_menu.add_command(label="Save Options...", command=self.open_save_options)
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.root.quit)
         
@@ -50,12 +154,17 @@ class AdvancedWatermarkRemoverPro:
         edit_menu = tk.Menu(menubar, tearoff=0)
         edit_menu.add_command(label="Undo", command=self.undo, accelerator="Ctrl+Z")
         edit_menu.add_command(label="Redo", command=self.redo, accelerator="Ctrl+Y")
+        edit_menu.add_separator()
+        edit_menu.add_command(label="Calibrate Auto Engine", command=self.calibrate_engines)
         
         # View Menu
         view_menu = tk.Menu(menubar, tearoff=0)
         view_menu.add_command(label="Zoom In", command=lambda: self.adjust_zoom(1.2))
         view_menu.add_command(label="Zoom Out", command=lambda: self.adjust_zoom(0.8))
         view_menu.add_command(label="Reset Zoom", command=self.reset_zoom)
+        view_menu.add_separator()
+        view_menu.add_checkbutton(label="Record Timing Trace...", variable=self.trace_enabled,
+                                  command=self.toggle_trace)
         
         menubar.add_cascade(label="File", menu=file_menu)
         menubar.add_cascade(label="Edit", menu=edit_menu)
@@ -89,6 +198,10 @@ class AdvancedWatermarkRemoverPro:
                                      command=lambda v: self.update_inpaint_radius(int(float(v))))
         self.radius_slider.set(self.inpaint_radius)
         self.radius_slider.pack(side=tk.LEFT, padx=10)
+        
+        engine_box = ttk.Combobox(toolbar, textvariable=self.engine_name, state="readonly", width=10,
+                                  values=["auto"] + sorted(ENGINES))
+        engine_box.pack(side=tk.LEFT, padx=10)
 
     def create_main_interface(self):
         main_frame = ttk.Frame(self.root)
@@ -97,9 +210,12 @@ class AdvancedWatermarkRemoverPro:
         self.canvas = tk.Canvas(main_frame, cursor="cross", bg='#2e2e2e')
         self.canvas.pack(fill=tk.BOTH, expand=True)
         
-        # Add scrollbars
-        self.hscroll = ttk.Scrollbar(main_frame, orient=tk.HORIZONTAL, command=self.canvas.xview)
-        self.vscroll = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=self.canvas.yview)
+        self.renderer = ViewportRenderer(self.canvas, profiler=self.profiler)
+        
+        # Add scrollbars; only the visible part is rendered, so scrolling
+        # and resizing redraw
+        self.hscroll = ttk.Scrollbar(main_frame, orient=tk.HORIZONTAL, command=self.on_xscroll)
+        self.vscroll = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=self.on_yscroll)
         self.canvas.configure(xscrollcommand=self.hscroll.set, yscrollcommand=self.vscroll.set)
         
         self.hscroll.pack(side=tk.BOTTOM, fill=tk.X)
@@ -120,11 +236,45 @@ class AdvancedWatermarkRemoverPro:
         self.statusbar = ttk.Label(self.root, text="Ready", anchor=tk.W)
         self.statusbar.pack(side=tk.BOTTOM, fill=tk.X)
 
+    def update_status(self, text):
+        self.statusbar.config(text=text)
+
+    def calibrate_engines(self):
+        # Times every engine on this machine for the "auto" choice. It takes
+        # a few cores for a while, so it only runs when asked for.
+        if self.calibration_runner.busy:
+            return
+        self.update_status("Calibrating engines...")
+        self.calibration_runner.submit(
+            self.engine_selector.calibrate,
+            on_done=lambda _: self.update_status("Engines calibrated for this machine"),
+            on_error=lambda e: self.update_status(f"Engine calibration failed: {e}")
+        )
+
+    def toggle_trace(self):
+        if not self.trace_enabled.get():
+            self.profiler.stop_trace()
+            return
+        # .json gives a Chrome trace, anything else JSON lines
+        path = filedialog.asksaveasfilename(
+            defaultextension=".jsonl",
+            filetypes=[('JSON Lines', '*.jsonl'), ('Chrome Trace', '*.json')]
+        )
+        if not path:
+            self.trace_enabled.set(False)
+            return
+        try:
+            self.profiler.start_trace(path)
+        except OSError as e:
+            self.trace_enabled.set(False)
+            messagebox.showerror("Trace Error", f"Failed to open trace file: {str(e)}")
+
     def bind_events(self):
         self.canvas.bind("<ButtonPress-1>", self.on_press)
         self.canvas.bind("<B1-Motion>", self.on_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_release)
         self.canvas.bind("<MouseWheel>", self.on_mousewheel)
+        self.canvas.bind("<Configure>", lambda e: self.renderer.render())
         self.canvas.bind("<Button-3>", self.on_right_click)
         self.root.bind("<Control-z>", self.undo)
         self.root.bind("<Control-y>", self.redo)
@@ -133,33 +283,190 @@ class AdvancedWatermarkRemoverPro:
 
     # Improved image processing methods
     def process_inpainting(self):
-        if self.original_image is None or self.mask is None:
+        if self.image_shape is None or self.stroke_rect is None:
+            return
+        if self.original_image is None or self.inpaint_step is not None or self.snapshots_pending:
+            # Only the proxy is in, a step is still running or a snapshot is
+            # being copied; run once it is done, as every step builds on the
+            # last
+            self.inpaint_waiting = True
+            if self.original_image is None:
+                self.update_status("Loading full resolution...")
             return
             
-        self.push_undo_state()
-        
-        try:
-            # Convert to BGR for OpenCV
-            img_bgr = cv2.cvtColor(self.original_image, cv2.COLOR_RGB2BGR)
-            
-            # Use different algorithms based on mask size
-            if np.sum(self.mask) < 10000:  # Small area
-                inpainted = cv2.inpaint(img_bgr, self.mask, self.inpaint_radius, cv2.INPAINT_TELEA)
-            else:  # Large area
-                inpainted = cv2.inpaint(img_bgr, self.mask, self.inpaint_radius, cv2.INPAINT_NS)
-            
-            self.processed_image = cv2.cvtColor(inpainted, cv2.COLOR_BGR2RGB)
-            self.update_display()
-            
-        except Exception as e:
-            messagebox.showerror("Processing Error", str(e))
+        op = self.profiler.begin("inpaint")
+        with op.stage("select"):
+            step = self.edit_step(self.stroke_rect)
+        self.stroke_rect = None
+        if step is None:
+            return
+        op.detail = step["meta"]["engine"]
+        self.inpaint_step = step
+        if step["mask"] is None:
+            # Only erased: nothing to inpaint
+            self.apply_inpainting([], step, op)
+            return
+
+        # Every engine treats channels independently, so the RGB buffer
+        # can be inpainted directly without a BGR round trip. The worker
+        # reads the window of the current result; nothing else writes to it
+        # until this step is applied or cancelled.
+        x0, y0, x1, y1 = step["window"]
+        source = self.processed_image[y0:y1, x0:x1]
+        mask, radius, engine = step["mask"], step["meta"]["radius"], step["meta"]["engine"]
+        area = (x1 - x0) * (y1 - y0)
+        if area > PREVIEW_MIN_PIXELS:
+            scale = (PREVIEW_PIXELS / area) ** 0.5
+            self.preview_runner.submit(
+                op.wrap("preview", inpaint_preview), source, mask, (0, 0, x1 - x0, y1 - y0), scale, radius,
+                PREVIEW_ENGINE,
+                on_done=lambda pixels: self.show_preview(pixels, step)
+            )
+
+        if self.processed_tiles is not None:
+            # Only tiles with masked pixels, plus a halo, are read
+            cached = self.inpaint_cache.engine(engine)
+            fn, args = inpaint_tiles, (source, mask, radius, cached, self.processed_tiles.tile_size)
+        else:
+            fn, args = inpaint_shared, (self.frames, step["window"], mask, radius, engine, self.inpaint_cache)
+        self.inpaint_runner.submit(
+            op.wrap("inpaint", fn), *args,
+            on_done=lambda patches: self.apply_inpainting(patches, step, op),
+            on_error=self.inpainting_failed
+        )
+
+    def edit_step(self, rect):
+        # The step for the mask changes in rect: pixels newly masked are
+        # inpainted in a window around rect, and pixels erased go back to
+        # the original. None if the mask ends up as it was.
+        x0, y0, x1, y1 = rect
+        current = self.mask[y0:y1, x0:x1] > 0
+        applied = self.history.baseline_mask[y0:y1, x0:x1] > 0
+        added = current & ~applied
+        erased = applied & ~current
+        if not added.any() and not erased.any():
+            return None
+
+        engine = self.engine_name.get()
+        radius = self.inpaint_radius
+        window, mask = rect, None
+        if added.any():
+            added = added.astype(np.uint8) * 255
+            if engine == "auto":
+                engine = self.engine_selector.choose(added, radius)
+            h, w = self.image_shape[:2]
+            m = get_engine(engine).halo(radius, rect)
+            window = max(0, x0 - m), max(0, y0 - m), min(w, x1 + m), min(h, y1 + m)
+            wx0, wy0, wx1, wy1 = window
+            mask = np.zeros((wy1 - wy0, wx1 - wx0), dtype=np.uint8)
+            mask[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0] = added
+        return {
+            "rect": rect,
+            "window": window,
+            "mask": mask,
+            "erased": erased,
+            # The mask as this step leaves it, for the undo history
+            "mask_pixels": self.mask[y0:y1, x0:x1].copy(),
+            "meta": {"rect": rect, "window": window, "engine": engine,
+                     "radius": radius if mask is not None else None},
+        }
+
+    def show_preview(self, pixels, step):
+        # Only while its step is still being computed
+        if self.inpaint_step is step:
+            self.renderer.set_preview(step["window"], pixels)
+
+    def cancel_inpainting(self, refresh=True):
+        # refresh=False leaves the view as it is for a step about to
+        # replace the cancelled one
+        self.inpaint_runner.cancel()
+        self.preview_runner.cancel()
+        self.renderer.clear_preview()
+        if self.inpaint_step is not None:
+            # Its mask changes are still to be applied
+            self.stroke_rect = union_rect(self.stroke_rect, self.inpaint_step["rect"])
+            if refresh:
+                self.renderer.set_image(self.processed_image, self.inpaint_step["window"])
+            self.inpaint_step = None
+
+    def inpainting_failed(self, e):
+        self.cancel_inpainting()
+        self.inpaint_waiting = False
+        messagebox.showerror("Processing Error", str(e))
+
+    def apply_inpainting(self, patches, step, op):
+        # Pastes the step's patches (relative to its window) and restores
+        # the erased pixels, recording what they replace for undo; redo
+        # pastes the result back from the history instead of recomputing it
+        self.profiler.settle(op)
+        self.inpaint_step = None
+        x0, y0, x1, y1 = step["window"]
+        with op.stage("undo"):
+            self.history.push(self.processed_image, step["window"], step["mask_pixels"], step["rect"],
+                              meta=step["meta"])
+        with op.stage("apply"):
+            for (px0, py0, px1, py1), pixels in patches:
+                self.processed_image[y0 + py0:y0 + py1, x0 + px0:x0 + px1] = pixels
+            erased = step["erased"]
+            if erased.any():
+                rx0, ry0, rx1, ry1 = step["rect"]
+                self.processed_image[ry0:ry1, rx0:rx1][erased] = self.original_image[ry0:ry1, rx0:rx1][erased]
+            self.show_changes(step["window"])
+        if self.inpaint_waiting:
+            self.inpaint_waiting = False
+            self.process_inpainting()
+
+    def on_inpaint_busy(self, busy):
+        if busy:
+            self.update_status("Inpainting...")
+        elif self.profiler.last is not None:
+            self.update_status(f"{self.profiler.last.summary()} | {self.inpaint_cache.summary()}")
+        else:
+            self.update_status("Ready")
 
     def update_brush_size(self, size):
         self.brush_size = max(1, min(50, size))
         self.update_cursor()
 
     def update_inpaint_radius(self, radius):
-        self.inpaint_radius = max(1, min(20, radius))
+        radius = max(1, min(20, radius))
+        if radius == self.inpaint_radius:
+            return
+        self.inpaint_radius = radius
+        # The slider fires on every pixel of a drag; only the value it
+        # settles on is inpainted
+        if self.radius_job is not None:
+            self.root.after_cancel(self.radius_job)
+        self.radius_job = self.root.after(RADIUS_DEBOUNCE_MS, self.retune_radius)
+
+    def retune_radius(self):
+        # Redoes the latest step at the new radius. Only that step's window
+        # is inpainted again, and results are cached by radius, so moving
+        # back to a radius already tried is a lookup.
+        self.radius_job = None
+        if self.original_image is None or self.mask is None:
+            return
+        if self.snapshots_pending:
+            # Undoing the last step would change the frame being copied
+            self.radius_job = self.root.after(RADIUS_DEBOUNCE_MS, self.retune_radius)
+            return
+        if self.inpaint_step is None and self.stroke_rect is None:
+            meta = self.history.last_meta
+            if meta is None or meta["radius"] is None or meta["radius"] == self.inpaint_radius:
+                return
+            # Put the step's window back as it was and keep its mask, so the
+            # step is computed again from the same pixels. The view keeps
+            # the old result until the new one replaces it.
+            x0, y0, x1, y1 = meta["rect"]
+            mask = self.mask[y0:y1, x0:x1].copy()
+            self.history.undo(self.processed_image, self.mask)
+            self.mask[y0:y1, x0:x1] = mask
+            self.stroke_rect = meta["rect"]
+        else:
+            # A step in flight was started at the old radius; it is
+            # superseded and its mask changes go into the new one
+            self.cancel_inpainting(refresh=False)
+        self.process_inpainting()
 
     def update_cursor(self):
         if self.selected_tool == "brush":
@@ -169,26 +476,79 @@ class AdvancedWatermarkRemoverPro:
         else:
             self.canvas.config(cursor="cross")
 
+    def select_rectangle_tool(self):
+        self.selected_tool = "rectangle"
+        self.update_cursor()
+
+    def select_brush_tool(self):
+        self.selected_tool = "brush"
+        self.update_cursor()
+
+    def select_eraser_tool(self):
+        self.selected_tool = "eraser"
+        self.update_cursor()
+
     # Enhanced drawing methods
-    def draw_on_mask(self, x, y, erase=False):
-        if self.original_image is None:
-            return
-            
-        img_x = int(x / self.zoom_level)
-        img_y = int(y / self.zoom_level)
-        
+    def canvas_to_image(self, event):
+        x = self.canvas.canvasx(event.x) / self.zoom_level
+        y = self.canvas.canvasy(event.y) / self.zoom_level
+        return int(x), int(y)
+
+    def ensure_mask(self):
         if self.mask is None:
-            self.mask = np.zeros(self.original_image.shape[:2], dtype=np.uint8)
-        
-        color = 0 if erase else 255
-        cv2.circle(self.mask, (img_x, img_y), self.brush_size, color, -1)
-        self.update_preview()
+            self.mask = np.zeros(self.image_shape[:2], dtype=np.uint8)
+            self.renderer.set_mask(self.mask)
+
+    def draw_on_mask(self, points):
+        # Called by the stroke rasterizer with a batch of samples, at most
+        # once per frame
+        if self.image_shape is None:
+            return
+        self.ensure_mask()
+        color = 0 if self.selected_tool == "eraser" else 255
+        rect = draw_stroke(self.mask, points, self.brush_size, color)
+        self.mark_mask_changed(rect)
+
+    def mark_mask_changed(self, rect):
+        self.stroke_rect = union_rect(self.stroke_rect, rect)
+        # Only this part of the view is re-blended
+        self.renderer.render_mask(rect)
+
+    def start_rect_selection(self, event):
+        self.last_point = (self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+        if self.rect_item is not None:
+            self.canvas.delete(self.rect_item)
+        self.rect_item = self.canvas.create_rectangle(*self.last_point, *self.last_point, outline='red', width=2)
+
+    def update_rect_selection(self, event):
+        if self.rect_item is not None:
+            self.canvas.coords(self.rect_item, *self.last_point,
+                               self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+
+    def process_rect_selection(self, event):
+        if self.rect_item is None:
+            return
+        self.canvas.delete(self.rect_item)
+        self.rect_item = None
+        if self.image_shape is None:
+            return
+        h, w = self.image_shape[:2]
+        x0, y0 = [int(v / self.zoom_level) for v in self.last_point]
+        x1, y1 = self.canvas_to_image(event)
+        x0, x1 = sorted((max(0, min(w, x0)), max(0, min(w, x1))))
+        y0, y1 = sorted((max(0, min(h, y0)), max(0, min(h, y1))))
+        if x0 == x1 or y0 == y1:
+            return
+        self.ensure_mask()
+        self.mask[y0:y1, x0:x1] = 255
+        self.mark_mask_changed((x0, y0, x1, y1))
 
     def update_preview(self):
-        if self.processed_image is not None and self.mask is not None:
-            preview = self.processed_image.copy()
-            preview[self.mask == 255] = [255, 0, 0]  # Red mask preview
-            self.display_image(preview)
+        # The red mask overlay is blended into the rendered viewport only
+        if self.image_shape is not None:
+            with self.profiler.stage("preview"):
+                self.renderer.set_mask(self.mask)
+                self.renderer.render()
 
 
     # Improved image handling
@@ -197,27 +557,154 @@ class AdvancedWatermarkRemoverPro:
         if not path:
             return
             
+        op = self.profiler.begin("open")
+        op.detail = os.path.basename(path)
         try:
-            img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-            if img is None:
-                raise ValueError("Unsupported image format")
-                
-            if len(img.shape) == 2:  # Grayscale
-                img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-            else:  # Color
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            with op.stage("probe"):
+                w, h, fmt = self.image_info(path)
+            if w * h >= TILED_MIN_PIXELS:
+                self.open_tiled_image(path, op)
+                return
+
+            zoom = self.fit_zoom(w, h)
+            factor = 1
+            while factor < 8 and factor * 2 * zoom <= 1:
+                factor *= 2
+            if fmt == "JPEG" and w * h >= PROXY_MIN_PIXELS and factor > 1:
+                self.open_proxy_image(path, op, (h, w, 3), factor, zoom)
+                return
+
+            # Decoded straight to 3 channels and swapped to RGB in place
+            with op.stage("decode"):
+                img = ImageBuffer.load(path, flags=LOAD_FLAGS).pixels
             
-            self.original_image = img
-            self.processed_image = img.copy()
-            self.mask = None
+            self.cancel_inpainting()
+            self.load_runner.cancel()
+            self.close_tiles()
+            self.profiler.settle(op)
+            with op.stage("copy"):
+                self.original_image = img
+                self.share_image(img)
+            self.image_shape = img.shape
+            self.reset_edit_state()
+            self.renderer.set_image(self.processed_image)
             self.reset_zoom()
             self.update_display()
             
         except Exception as e:
             messagebox.showerror("Loading Error", f"Failed to load image: {str(e)}")
 
+    def image_info(self, path):
+        # (width, height, format) from the header only, so large files can
+        # be routed to the tiled backend or a proxy before anything is decoded
+        try:
+            with Image.open(path) as probe:
+                return probe.size[0], probe.size[1], probe.format
+        except Image.DecompressionBombError:
+            # Raised by PIL's size guard, so it is certainly a large image
+            return TILED_MIN_PIXELS, 1, None
+        except Exception:
+            return 0, 0, None
+
+    def fit_zoom(self, w, h):
+        cw, ch = self.canvas.winfo_width(), self.canvas.winfo_height()
+        if cw <= 1 or ch <= 1:
+            return 1.0
+        return min(1.0, cw / w, ch / h)
+
+    def open_proxy_image(self, path, op, shape, factor, zoom):
+        # The reduced decode only runs the JPEG decoder at 1/factor scale, so
+        # it is ready in a fraction of the full decode's time. Strokes go
+        # into a full-resolution mask meanwhile.
+        with op.stage("proxy"):
+            proxy = ImageBuffer.load(path, flags=PROXY_FLAGS[factor] | cv2.IMREAD_IGNORE_ORIENTATION).pixels
+        self.cancel_inpainting()
+        self.close_tiles()
+        self.profiler.settle(op)
+        self.original_image = None
+        self.processed_image = None
+        self.image_shape = shape
+        self.reset_edit_state()
+        self.renderer.set_proxy(proxy, factor, shape)
+        self.zoom_level = zoom
+        self.update_display()
+
+        load_op = self.profiler.begin("full decode")
+        load_op.detail = os.path.basename(path)
+        self.load_runner.submit(
+            load_op.wrap("decode", ImageBuffer.load), path, "RGB", LOAD_FLAGS,
+            on_done=lambda img: self.apply_full_image(img, load_op),
+            on_error=self.full_image_failed
+        )
+
+    def full_image_failed(self, e):
+        self.inpaint_waiting = False
+        messagebox.showerror("Loading Error", f"Failed to load image: {str(e)}")
+
+    def apply_full_image(self, img, op):
+        self.profiler.settle(op)
+        with op.stage("copy"):
+            self.original_image = img
+            self.share_image(img)
+        if img.shape != self.image_shape:
+            # The header disagreed with the decoder; strokes can't be mapped
+            self.image_shape = img.shape
+            self.reset_edit_state()
+        self.renderer.set_image(self.processed_image)
+        self.update_display()
+        if self.inpaint_waiting:
+            self.inpaint_waiting = False
+            self.process_inpainting()
+
+    def share_image(self, img):
+        # processed_image starts as a copy of img in the shared "image"
+        # frame, reusing its segment when the new image fits
+        self.processed_image = self.frames.frame("image", img.shape, img.dtype)
+        self.processed_image[...] = img
+
+    def open_tiled_image(self, path, op):
+        with op.stage("decode"):
+            original = TiledImage.load(path)
+        with op.stage("copy"):
+            processed = TiledImage.from_array(original.pixels)
+        self.cancel_inpainting()
+        self.load_runner.cancel()
+        self.close_tiles()
+        self.profiler.settle(op)
+        self.original_tiles = original
+        self.processed_tiles = processed
+        self.original_image = original.pixels
+        self.processed_image = processed.pixels
+        self.image_shape = original.shape
+        self.reset_edit_state()
+        self.renderer.set_image(self.processed_image)
+        # The in-RAM frame's shared segment isn't used by tiled images; a
+        # cancelled step may still be reading it
+        self.inpaint_runner.when_idle(lambda: self.frames.drop("image"))
+        self.reset_zoom()
+        self.update_display()
+
+    def reset_edit_state(self):
+        self.mask = None
+        self.stroke_rect = None
+        self.inpaint_step = None
+        self.inpaint_waiting = False
+        self.history.reset(self.image_shape[:2])
+
+    def close_tiles(self):
+        # A cancelled step may still be reading the tiles, so they are
+        # closed once it has finished
+        opened = [tiles for tiles in (self.original_tiles, self.processed_tiles) if tiles is not None]
+
+        def close():
+            for tiles in opened:
+                tiles.close()
+        self.inpaint_runner.when_idle(close)
+        self.original_tiles = None
+        self.processed_tiles = None
+
     def save_image(self):
-        if self.processed_image is None:
+        if self.image_shape is None:
             return
             
         path = filedialog.asksaveasfilename(
@@ -231,12 +718,97 @@ class AdvancedWatermarkRemoverPro:
         )
         
         if path:
-            try:
-                img = Image.fromarray(self.processed_image)
-                img.save(path, quality=95)
-                messagebox.showinfo("Success", "Image saved successfully!")
-            except Exception as e:
-                messagebox.showerror("Saving Error", f"Failed to save image: {str(e)}")
+            self.write_image(path)
+
+    def write_image(self, path):
+        # What is on screen may still be a low-resolution preview, so the
+        # file is written only once the full-resolution result is in
+        if self.load_runner.busy or self.inpaint_waiting or self.inpaint_runner.busy:
+            self.update_status("Waiting for processing to finish before saving...")
+            self.root.after(100, self.write_image, path)
+            return
+        op = self.profiler.begin("save")
+        op.detail = os.path.basename(path)
+        self.update_status(f"Saving {op.detail}...")
+        # Undo/redo and inpainting change processed_image in place, so the
+        # encoder works on a snapshot and editing carries on
+        if self.processed_tiles is not None:
+            # Copying a memory-mapped frame can take seconds, so it runs on
+            # the save runner and edits wait for it
+            self.snapshots_pending += 1
+            self.save_runner.submit(
+                op.wrap("snapshot", TiledImage.from_array), self.processed_tiles.pixels,
+                on_done=lambda snapshot: self.encode_image(snapshot.pixels, path, op, snapshot),
+                on_error=self.snapshot_failed
+            )
+            return
+        try:
+            with op.stage("snapshot"):
+                pixels = self.processed_image.copy()
+        except Exception as e:
+            messagebox.showerror("Saving Error", f"Failed to save image: {str(e)}")
+            return
+        self.encode_image(pixels, path, op)
+
+    def encode_image(self, pixels, path, op, snapshot=None):
+        if snapshot is not None:
+            self.snapshot_done()
+        options = {fmt: dict(settings) for fmt, settings in self.save_options.items()}
+        self.save_runner.submit(
+            op.wrap("encode", encode_snapshot), ImageBuffer(pixels), path, options, snapshot,
+            on_done=lambda stats: self.save_finished(op, stats),
+            on_error=lambda e: messagebox.showerror("Saving Error", f"Failed to save image: {str(e)}")
+        )
+
+    def snapshot_failed(self, e):
+        self.snapshot_done()
+        messagebox.showerror("Saving Error", f"Failed to save image: {str(e)}")
+
+    def snapshot_done(self):
+        self.snapshots_pending -= 1
+        if not self.snapshots_pending and self.inpaint_waiting:
+            self.inpaint_waiting = False
+            self.process_inpainting()
+
+    def save_finished(self, op, stats):
+        seconds, size = stats
+        op.detail = f"{op.detail}, {size / 2 ** 20:.1f} MB"
+        self.profiler.finish(op)
+        messagebox.showinfo("Success", "Image saved successfully!")
+
+    def open_save_options(self):
+        # Speed-versus-size settings for each output format
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Save Options")
+        dialog.transient(self.root)
+        png, jpeg, webp = (self.save_options[fmt] for fmt in ("png", "jpeg", "webp"))
+        fields = [
+            ("PNG compression (0-9)", tk.IntVar(value=png["compression"]), ("png", "compression"), range(10)),
+            ("PNG strategy", tk.StringVar(value=png["strategy"]), ("png", "strategy"),
+             ("default", "filtered", "huffman", "rle", "fixed")),
+            ("PNG filter", tk.StringVar(value=png["filter"]), ("png", "filter"), ("none", "sub", "up")),
+            ("JPEG quality", tk.IntVar(value=jpeg["quality"]), ("jpeg", "quality"), range(101)),
+            ("JPEG optimise", tk.BooleanVar(value=jpeg["optimize"]), ("jpeg", "optimize"), None),
+            ("JPEG progressive", tk.BooleanVar(value=jpeg["progressive"]), ("jpeg", "progressive"), None),
+            ("WebP quality", tk.IntVar(value=webp["quality"]), ("webp", "quality"), range(101)),
+            ("WebP method (0 fast - 6 small)", tk.IntVar(value=webp["method"]), ("webp", "method"), range(7)),
+            ("WebP lossless", tk.BooleanVar(value=webp["lossless"]), ("webp", "lossless"), None),
+        ]
+        for row, (label, var, _, values) in enumerate(fields):
+            if values is None:
+                ttk.Checkbutton(dialog, text=label, variable=var).grid(row=row, column=0, columnspan=2,
+                                                                       sticky=tk.W, padx=8, pady=2)
+                continue
+            ttk.Label(dialog, text=label).grid(row=row, column=0, sticky=tk.W, padx=8, pady=2)
+            ttk.Combobox(dialog, textvariable=var, values=list(values), width=6,
+                         state="readonly").grid(row=row, column=1, padx=8, pady=2)
+
+        def apply():
+            for _, var, (fmt, key), _ in fields:
+                self.save_options[fmt][key] = var.get()
+            dialog.destroy()
+
+        ttk.Button(dialog, text="OK", command=apply).grid(row=len(fields), column=0, columnspan=2, pady=8)
 
     # Enhanced zoom and scroll
     def adjust_zoom(self, factor):
@@ -244,74 +816,90 @@ class AdvancedWatermarkRemoverPro:
         self.update_display()
 
     def update_display(self):
-        if self.processed_image is None:
+        if self.image_shape is None:
             return
             
-        img = Image.fromarray(self.processed_image)
-        w, h = img.size
-        new_size = (int(w * self.zoom_level), int(h * self.zoom_level))
-        img = img.resize(new_size, Image.LANCZOS)
-        
-        self.tk_image = ImageTk.PhotoImage(img)
-        self.canvas.config(scrollregion=(0, 0, *new_size))
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
-        self.update_preview()
+        with self.profiler.operation("display"):
+            self.renderer.set_zoom(self.zoom_level)
+            self.update_preview()
 
-    # Improved undo/redo system
-    def push_undo_state(self):
-        self.undo_stack.append({
-            'image': self.processed_image.copy(),
-            'mask': self.mask.copy() if self.mask is not None else None
-        })
-        self.redo_stack.clear()
+    def on_xscroll(self, *args):
+        self.canvas.xview(*args)
+        self.renderer.render()
 
+    def on_yscroll(self, *args):
+        self.canvas.yview(*args)
+        self.renderer.render()
+
+    # Improved undo/redo system
+    # Each step keeps the pixels its window had before and after it, so
+    # both directions are a paste
     def undo(self, event=None):
-        if self.undo_stack:
-            state = self.undo_stack.pop()
-            self.redo_stack.append({
-                'image': self.processed_image.copy(),
-                'mask': self.mask.copy() if self.mask is not None else None
-            })
-            self.processed_image = state['image']
-            self.mask = state['mask']
-            self.update_display()
+        if self.snapshots_pending:
+            self.update_status("Saving, undo is available once the snapshot is taken")
+            return
+        if self.discard_stroke():
+            # The latest action was the stroke, not the last applied step
+            return
+        if self.history.can_undo and self.mask is not None:
+            self.show_changes(self.history.undo(self.processed_image, self.mask)["window"])
 
     def redo(self, event=None):
-        if self.redo_stack:
-            state = self.redo_stack.pop()
-            self.undo_stack.append({
-                'image': self.processed_image.copy(),
-                'mask': self.mask.copy() if self.mask is not None else None
-            })
-            self.processed_image = state['image']
-            self.mask = state['mask']
-            self.update_display()
+        if self.snapshots_pending:
+            self.update_status("Saving, redo is available once the snapshot is taken")
+            return
+        self.discard_stroke()
+        if self.history.can_redo and self.mask is not None:
+            self.show_changes(self.history.redo(self.processed_image, self.mask)["window"])
+
+    def discard_stroke(self):
+        # Takes back mask changes not yet applied as a step, including one
+        # being inpainted, leaving the history as it is. Returns whether
+        # there were any.
+        self.cancel_inpainting()
+        if self.stroke_rect is None or self.mask is None:
+            return False
+        x0, y0, x1, y1 = rect = self.stroke_rect
+        self.mask[y0:y1, x0:x1] = self.history.baseline_mask[y0:y1, x0:x1]
+        self.stroke_rect = None
+        self.renderer.render_mask(rect)
+        return True
+
+    def show_changes(self, rect):
+        # processed_image changed inside rect
+        self.renderer.set_image(self.processed_image, rect)
+        self.update_display()
 
     def reset_zoom(self):
         self.zoom_level = 1.0
         self.update_display()
 
-    def adjust_zoom(self, factor):
-        self.zoom_level = max(0.1, min(5.0, self.zoom_level * factor))
-        self.update_display()
+    def on_mousewheel(self, event):
+        if event.delta > 0:
+            self.adjust_zoom(1.2)
+        else:
+            self.adjust_zoom(0.8)
 
     # Event handlers
+    # Pointer samples are only collected here; the stroke rasterizer draws
+    # them into the mask in batches on its frame tick
     def on_press(self, event):
-        self.last_point = (event.x, event.y)
         if self.selected_tool in ["brush", "eraser"]:
-            self.draw_on_mask(event.x, event.y, erase=(self.selected_tool == "eraser"))
+            self.stroke.begin(self.canvas_to_image(event))
         elif self.selected_tool == "rectangle":
             self.start_rect_selection(event)
 
     def on_drag(self, event):
         if self.selected_tool in ["brush", "eraser"]:
-            self.draw_on_mask(event.x, event.y, erase=(self.selected_tool == "eraser"))
+            self.stroke.add(self.canvas_to_image(event))
         elif self.selected_tool == "rectangle":
             self.update_rect_selection(event)
 
     def on_release(self, event):
         if self.selected_tool == "rectangle":
             self.process_rect_selection(event)
+        else:
+            self.stroke.end()
         self.process_inpainting()
 
     def on_right_click(self, event):
@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+
+from inpaint_engine import rect_mask
+
+DEFAULT_SCALES = (0.8, 0.9, 1.0, 1.1, 1.25)
+
+# The coarse search runs on a pyramid level where the smallest scaled
+# template is still at least this many pixels on its short side
+MIN_TEMPLATE_SIDE = 16
+
+
+def to_gray(image):
+    if image.ndim == 2:
+        return image
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def match(image, template):
+    # cv2.matchTemplate switches to DFT-based correlation by itself once the
+    # template is large enough, so big logos don't need a separate code path
+    result = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+    # Flat regions give 0/0 in the normalisation
+    np.nan_to_num(result, copy=False, nan=-1.0, posinf=-1.0, neginf=-1.0)
+    _, score, _, loc = cv2.minMaxLoc(result)
+    return score, loc
+
+
+def pyramid_level(template_shape, scales):
+    side = min(template_shape[:2]) * min(scales)
+    level = 0
+    while side / 2 ** (level + 1) >= MIN_TEMPLATE_SIDE:
+        level += 1
+    return level
+
+
+def locate_watermark(image, template, scales=DEFAULT_SCALES):
+    # Returns ((x, y, w, h), score) for the best match over all scales, or
+    # (None, -1.0) if the template doesn't fit in the image at any scale.
+    gray = to_gray(image)
+    tmpl = to_gray(template)
+    th, tw = tmpl.shape
+    h, w = gray.shape
+
+    level = pyramid_level(tmpl.shape, scales)
+    small = gray
+    for _ in range(level):
+        small = cv2.pyrDown(small)
+    factor = 2 ** level
+
+    # Coarse pass: every scale on the reduced image
+    best = None
+    for scale in scales:
+        sw, sh = int(round(tw * scale)), int(round(th * scale))
+        if sw > w or sh > h:
+            continue
+        coarse = cv2.resize(tmpl, (max(1, round(sw / factor)), max(1, round(sh / factor))),
+                            interpolation=cv2.INTER_AREA)
+        if coarse.shape[0] > small.shape[0] or coarse.shape[1] > small.shape[1]:
+            continue
+        score, loc = match(small, coarse)
+        if best is None or score > best[0]:
+            best = (score, sw, sh, loc)
+    if best is None:
+        return None, -1.0
+
+    # Fine pass: the winning scale at full resolution, only around the
+    # coarse hit, so its cost doesn't grow with the image
+    score, sw, sh, (cx, cy) = best
+    if factor == 1:
+        return (cx, cy, sw, sh), score
+    slack = 2 * factor
+    x0 = max(0, cx * factor - slack)
+    y0 = max(0, cy * factor - slack)
+    x1 = min(w, cx * factor + sw + slack)
+    y1 = min(h, cy * factor + sh + slack)
+    full = cv2.resize(tmpl, (sw, sh), interpolation=cv2.INTER_AREA if sw < tw else cv2.INTER_LINEAR)
+    score, (fx, fy) = match(gray[y0:y1, x0:x1], full)
+    return (x0 + fx, y0 + fy, sw, sh), score
+
+
+def detect_mask(image, template, threshold=0.7, scales=DEFAULT_SCALES, pad=2):
+    # Builds an inpainting mask around the located watermark. Returns
+    # (mask, box, score); mask and box are None when the best match scores
+    # below threshold.
+    box, score = locate_watermark(image, template, scales)
+    if box is None or score < threshold:
+        return None, None, score
+    x, y, w, h = box
+    mask = rect_mask(image.shape, (max(0, x - pad), max(0, y - pad), w + 2 * pad, h + 2 * pad))
+    return mask, box, score
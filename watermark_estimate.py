@@ -0,0 +1,273 @@
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from inpaint_engine import inpaint_region, mask_bbox, rect_mask
+
+# Statistics are kept for the watermark region plus this many pixels
+# around it, so its outline and the background next to it are included
+MARGIN = 8
+
+# Above this opacity the reverse blend amplifies noise more than it
+# recovers; those pixels are inpainted instead
+MAX_ALPHA = 0.85
+
+# How strongly the opacity from the colour fit is pulled towards the
+# opacity from the loss of contrast, where the two colours are close
+ALPHA_PRIOR = 400.0
+
+
+class StreamingMedian:
+    # Per-pixel running median in constant memory. Each sample moves the
+    # estimate towards it by 2 / n of the running mean absolute deviation
+    # (kept as `spread`), a stochastic approximation that lands within
+    # about the median's own sampling error.
+    def __init__(self):
+        self.estimate = None
+        self.spread = None
+        self.count = 0
+
+    def add(self, values):
+        self.count += 1
+        if self.estimate is None:
+            self.estimate = values.astype(np.float32)
+            self.spread = np.zeros_like(self.estimate)
+            return
+        deviation = values - self.estimate
+        self.spread += (np.abs(deviation) - self.spread) / self.count
+        self.estimate += np.sign(deviation) * self.spread * np.float32(2 / self.count)
+
+
+def gradients(region):
+    # Forward differences, zero on the last row/column, which is the
+    # discretisation poisson_solve() inverts exactly
+    gx = np.zeros_like(region)
+    gy = np.zeros_like(region)
+    gx[:, :-1] = region[:, 1:] - region[:, :-1]
+    gy[:-1] = region[1:] - region[:-1]
+    return gx, gy
+
+
+def poisson_solve(gx, gy):
+    # The image (up to a constant per channel) whose gradients best match
+    # gx, gy, with reflecting borders. The mirrored problem is periodic, so
+    # it is diagonalised by the FFT.
+    div = gx.copy()
+    div[:, 1:] -= gx[:, :-1]
+    div += gy
+    div[1:] -= gy[:-1]
+    h, w = div.shape[:2]
+    mirrored = np.concatenate([div, div[::-1]], axis=0)
+    mirrored = np.concatenate([mirrored, mirrored[:, ::-1]], axis=1)
+    ky = 2 * np.cos(np.pi * np.arange(2 * h) / h)[:, None]
+    kx = 2 * np.cos(np.pi * np.arange(w + 1) / w)[None, :]
+    eigen = ky + kx - 4
+    eigen[0, 0] = 1
+    result = np.empty_like(div)
+    for c in range(div.shape[2]):
+        spectrum = np.fft.rfft2(mirrored[..., c]) / eigen
+        spectrum[0, 0] = 0
+        result[..., c] = np.fft.irfft2(spectrum, s=(2 * h, 2 * w))[:h, :w]
+    return result
+
+
+def fill(values, mask):
+    # Values under mask interpolated from around it, per channel
+    filled = np.empty_like(values)
+    for c in range(values.shape[2]):
+        filled[..., c] = cv2.inpaint(values[..., c], mask, 5, cv2.INPAINT_TELEA)
+    return filled
+
+
+class Watermark:
+    # A watermark blended over images as J = alpha * color + (1 - alpha) * I
+    # at a fixed rectangle. alpha is per pixel, color one value per channel
+    # in the channel order of the images it was estimated from.
+    def __init__(self, rect, alpha, color):
+        self.rect = tuple(int(v) for v in rect)
+        self.alpha = alpha.astype(np.float32)
+        self.color = np.asarray(color, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["rect"], data["alpha"], data["color"])
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez_compressed(f, rect=np.array(self.rect), alpha=self.alpha, color=self.color)
+
+    def mask(self, shape):
+        # Where the watermark is visible, as an 8-bit mask of the image
+        x0, y0, x1, y1 = self.rect
+        mask = np.zeros(shape[:2], dtype=np.uint8)
+        mask[y0:y1, x0:x1][self.alpha > 1 / 255] = 255
+        return mask
+
+    def remove(self, image, dst=None):
+        # Inverts the blend in one vectorised pass over the rectangle. Pixels
+        # too opaque to invert are inpainted. The result is written into dst
+        # (a copy of image by default) and returned.
+        x0, y0, x1, y1 = self.rect
+        h, w = image.shape[:2]
+        if x1 > w or y1 > h:
+            raise ValueError(f"watermark at {self.rect} does not fit a {w}x{h} image")
+        if dst is None:
+            dst = image.copy()
+        elif dst is not image:
+            dst[...] = image
+        alpha = np.minimum(self.alpha, MAX_ALPHA)[..., None]
+        region = image[y0:y1, x0:x1].astype(np.float32)
+        restored = (region - alpha * self.color) / (1 - alpha)
+        dst[y0:y1, x0:x1] = np.clip(restored + 0.5, 0, 255).astype(np.uint8)
+        opaque = (self.alpha > MAX_ALPHA).astype(np.uint8) * 255
+        if opaque.any():
+            window = np.ascontiguousarray(dst[y0:y1, x0:x1])
+            dst[y0:y1, x0:x1] = inpaint_region(window, opaque, 3, "telea")
+        return dst
+
+
+class WatermarkEstimator:
+    # Recovers a watermark shared by many images from streaming per-pixel
+    # statistics of the region it sits in: medians of the gradients, which
+    # outline the watermark since image content averages out, and the
+    # median and mean absolute deviation of the pixels. Memory depends on
+    # the region size only, however many images are added.
+    def __init__(self, mask):
+        self.shape = mask.shape[:2]
+        bbox = mask_bbox(mask)
+        if bbox is None:
+            raise ValueError("watermark mask is empty")
+        h, w = self.shape
+        x0, y0, x1, y1 = bbox
+        self.rect = max(0, x0 - MARGIN), max(0, y0 - MARGIN), min(w, x1 + MARGIN), min(h, y1 + MARGIN)
+        rx0, ry0, rx1, ry1 = self.rect
+        # Where the watermark may be: the given mask, grown by the margin
+        self.allowed = cv2.dilate(mask[ry0:ry1, rx0:rx1], np.ones((2 * MARGIN + 1,) * 2, np.uint8)) > 0
+        self.pixels = StreamingMedian()
+        self.gx = StreamingMedian()
+        self.gy = StreamingMedian()
+
+    @property
+    def count(self):
+        return self.pixels.count
+
+    def add(self, image):
+        if image.shape[:2] != self.shape:
+            raise ValueError(f"image is {image.shape[1]}x{image.shape[0]}, "
+                             f"expected {self.shape[1]}x{self.shape[0]}")
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        x0, y0, x1, y1 = self.rect
+        region = image[y0:y1, x0:x1, :3].astype(np.float32)
+        gx, gy = gradients(region)
+        self.pixels.add(region)
+        self.gx.add(gx)
+        self.gy.add(gy)
+
+    def estimate(self):
+        if self.count < 2:
+            raise ValueError("at least two images are needed")
+        # The watermark's outline: median gradients well above the noise
+        # left in them. Integrating them gives its visible difference from
+        # the background, whose footprint is the support.
+        gx, gy = self.gx.estimate, self.gy.estimate
+        magnitude = np.sqrt((gx * gx + gy * gy).sum(axis=2))
+        noise = np.median(magnitude[~self.allowed]) if (~self.allowed).any() else np.median(magnitude)
+        keep = (magnitude > max(1.0, 3 * noise))[..., None]
+        outline = poisson_solve(gx * keep, gy * keep)
+        border = np.concatenate([outline[0], outline[-1], outline[:, 0], outline[:, -1]])
+        outline -= np.median(border, axis=0)
+        support = (np.abs(outline).max(axis=2) > max(2.0, 3 * noise)) & self.allowed
+        if not support.any():
+            support = self.allowed
+        support = cv2.dilate(support.astype(np.uint8), np.ones((5, 5), np.uint8)) > 0
+        support &= self.allowed
+        hole = support.astype(np.uint8) * 255
+
+        # Background median and contrast under the watermark, from around it
+        median, spread = self.pixels.estimate, self.pixels.spread
+        background = fill(median, hole)
+        contrast = fill(spread, hole)
+
+        # The blend scales contrast by (1 - alpha), and shifts the median
+        # by alpha * (color - background)
+        shift = median - background
+        alpha_contrast = 1 - (spread.sum(axis=2) / np.maximum(contrast.sum(axis=2), 1e-3))
+        alpha_contrast = np.clip(alpha_contrast, 0, 1) * support
+        strong = support & (alpha_contrast > 0.3)
+        if strong.sum() >= 10:
+            color = np.median(background[strong] + shift[strong] / alpha_contrast[strong][:, None], axis=0)
+        else:
+            # Faint watermarks barely change the contrast; take the colour
+            # the median moved towards
+            color = np.where(shift[support].mean(axis=0) >= 0, 255.0, 0.0)
+        color = np.clip(color, 0, 255)
+
+        # Opacity as the least-squares fit of shift = alpha * (color -
+        # background) over the channels, steadied by the contrast estimate
+        # where color and background are close
+        towards = color - background
+        alpha = ((shift * towards).sum(axis=2) + ALPHA_PRIOR * alpha_contrast) / (
+            (towards * towards).sum(axis=2) + ALPHA_PRIOR)
+        alpha = np.clip(alpha, 0, 1) * support
+        return Watermark(self.rect, alpha, color)
+
+
+def estimate_watermark(paths, mask, limit=None, progress=None):
+    # One image in memory at a time; unreadable or differently sized images
+    # are skipped
+    estimator = WatermarkEstimator(mask)
+    for path in paths[:limit]:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is None:
+            continue
+        try:
+            estimator.add(image)
+        except ValueError:
+            continue
+        if progress is not None:
+            progress(estimator.count)
+    return estimator.estimate()
+
+
+def main(argv=None):
+    # batch_remove uses this module, so its helpers are imported here
+    from batch_remove import collect_inputs, load_mask, parse_roi
+
+    parser = argparse.ArgumentParser(description="Estimate a watermark shared by many images.")
+    parser.add_argument("input", help="input directory or glob pattern")
+    parser.add_argument("-o", "--output", required=True, help="watermark file to write (.npz)")
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument("--roi", type=parse_roi, help="area the watermark lies in, as x,y,w,h")
+    region.add_argument("--mask", help="mask image; non-zero pixels may be watermark")
+    parser.add_argument("--limit", type=int, help="use at most this many images")
+    args = parser.parse_args(argv)
+
+    paths = collect_inputs(args.input)
+    if not paths:
+        print("Error: No input images found")
+        return 1
+    first = cv2.imread(paths[0], cv2.IMREAD_COLOR)
+    if first is None:
+        print(f"Error: Could not load {paths[0]}")
+        return 1
+    mask = load_mask(args.mask) if args.mask else rect_mask(first.shape, args.roi)
+
+    start = time.perf_counter()
+    try:
+        watermark = estimate_watermark(paths, mask, args.limit)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    watermark.save(args.output)
+    print(f"Estimated watermark at {watermark.rect} (colour {watermark.color.round().tolist()}, "
+          f"peak opacity {watermark.alpha.max():.2f}) in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
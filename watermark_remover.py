@@ -89,6 +89,9 @@ from PIL import Image, ImageTk, ImageDraw
 import cv2
 import numpy as np
 import os
+from image_buffer import ImageBuffer
+from undo_history import UndoHistory
+from inpaint_engine import inpaint_patch
 
 class AdvancedWatermarkRemover:
     def __init__(self, root):
@@ -99,12 +102,13 @@ class AdvancedWatermarkRemover:
         # State management
         self.history = []
         self.current_step = -1
-        self.undo_stack = []
-        self.redo_stack = []
+        # Per-step undo/redo of just the window each step changed
+        self.undo_history = UndoHistory()
         
         # Image variables
         self.original_image = None
         self.processed_image = None
+        self.tk_image = None
         self.mask = None
         self.zoom_level = 1.0
         
@@ -229,10 +233,8 @@ class AdvancedWatermarkRemover:
         # Draw on mask
         cv2.circle(self.mask, (img_x, img_y), self.brush_size, 255, -1)
         
-        # Show preview
-        temp_image = self.processed_image.copy()
-        temp_image[self.mask == 255] = [255, 0, 0]  # Highlight selected area
-        self.display_image(temp_image)
+        # Show preview with the selected area highlighted
+        self.display_image(self.processed_image, self.mask)
 
     def draw_rectangle(self, x, y):
         if self.rect:
@@ -266,43 +268,32 @@ class AdvancedWatermarkRemover:
     
     def process_brush_selection(self):
         self.process_inpainting()
-        self.mask = None  # Reset mask after processing
     
     def process_inpainting(self):
         if self.original_image is None or self.mask is None:
             return
         
-        # Save state for undo
-        self.push_undo_state()
-        
-        # Advanced inpainting with parameters
-        inpainted = cv2.inpaint(
-            cv2.cvtColor(self.original_image, cv2.COLOR_RGB2BGR),
-            self.mask,
-            inpaintRadius=7,
-            flags=cv2.INPAINT_NS
-        )
-        
-        self.processed_image = cv2.cvtColor(inpainted, cv2.COLOR_BGR2RGB)
+        # Each selection is inpainted on top of the current result, so
+        # earlier fixes stay and only the new selection's window is redone
+        mask, self.mask = self.mask, None
+        patch = inpaint_patch(self.processed_image, mask, radius=7, engine="ns")
+        if patch is not None:
+            # Save state for undo
+            (x0, y0, x1, y1), pixels = patch
+            self.undo_history.push(self.processed_image, (x0, y0, x1, y1), None, None)
+            self.processed_image[y0:y1, x0:x1] = pixels
         self.display_image(self.processed_image)
     
     # ... [Undo/redo, zoom, and utility methods] ...
-
-    def push_undo_state(self):
-        if self.processed_image is not None:
-            self.undo_stack.append(self.processed_image.copy())
-            self.redo_stack.clear()
     
     def undo(self, event=None):
-        if len(self.undo_stack) > 0:
-            self.redo_stack.append(self.processed_image.copy())
-            self.processed_image = self.undo_stack.pop()
+        if self.undo_history.can_undo:
+            self.undo_history.undo(self.processed_image, None)
             self.display_image(self.processed_image)
     
     def redo(self, event=None):
-        if len(self.redo_stack) > 0:
-            self.undo_stack.append(self.processed_image.copy())
-            self.processed_image = self.redo_stack.pop()
+        if self.undo_history.can_redo:
+            self.undo_history.redo(self.processed_image, None)
             self.display_image(self.processed_image)
     
     def adjust_zoom(self, factor):
@@ -319,20 +310,23 @@ class AdvancedWatermarkRemover:
         else:
             self.adjust_zoom(0.8)
     
-    def display_image(self, image=None):
+    def display_image(self, image=None, mask=None):
         if image is None:
             return
         
         # Resize based on zoom level
         height, width = image.shape[:2]
-        new_width = int(width * self.zoom_level)
-        new_height = int(height * self.zoom_level)
-        
-        img_pil = Image.fromarray(image).resize((new_width, new_height))
-        self.tk_image = ImageTk.PhotoImage(img_pil)
+        new_width = max(1, int(width * self.zoom_level))
+        new_height = max(1, int(height * self.zoom_level))
         
+        # Only the zoomed frame is built; a same-size photo is updated in place
+        photo = ImageBuffer(image).photo((new_width, new_height), reuse=self.tk_image, mask=mask)
         self.canvas.config(width=new_width, height=new_height)
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
+        if photo is not self.tk_image:
+            self.tk_image = photo
+            self.canvas.delete("image")
+            self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image, tags="image")
+            self.canvas.tag_lower("image")
     
     # ... [Rest of the methods] ...
 
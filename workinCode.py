@@ -4,6 +4,10 @@ from PIL import Image, ImageTk, ImageDraw
 import cv2
 import numpy as np
 import os
+from image_buffer import ImageBuffer
+from inpaint_engine import inpaint_patch
+from task_runner import OrderedTaskRunner
+from undo_history import UndoHistory
 
 class AdvancedWatermarkRemover:
     def __init__(self, root):
@@ -12,10 +16,12 @@ class AdvancedWatermarkRemover:
         self.root.geometry("1000x700")
         self.history = []
         self.current_step = -1
-        self.undo_stack = []
-        self.redo_stack = []
+        # Per-step undo/redo of just the window each step changed
+        self.undo_history = UndoHistory()
         self.original_image = None
         self.processed_image = None
+        self.tk_image = None
+        self.save_runner = OrderedTaskRunner(self.root)
         self.mask = None
         self.zoom_level = 1.0
         self.selected_tool = "rectangle"
@@ -119,9 +125,7 @@ class AdvancedWatermarkRemover:
         if self.mask is None:
             self.mask = np.zeros(self.original_image.shape[:2], dtype=np.uint8)
         cv2.circle(self.mask, (img_x, img_y), self.brush_size, 255, -1)
-        temp_image = self.processed_image.copy()
-        temp_image[self.mask == 255] = [255, 0, 0]
-        self.display_image(temp_image)
+        self.display_image(self.processed_image, self.mask)
 
     def process_rectangle_selection(self, event):
         x0 = int(self.start_x / self.zoom_level)
@@ -135,36 +139,28 @@ class AdvancedWatermarkRemover:
 
     def process_brush_selection(self):
         self.process_inpainting()
-        self.mask = None
 
     def process_inpainting(self):
+        # Each selection is inpainted on top of the current result, so
+        # earlier fixes stay and only the new selection's window is redone
         if self.original_image is None or self.mask is None:
             return
-        self.push_undo_state()
-        inpainted = cv2.inpaint(
-            cv2.cvtColor(self.original_image, cv2.COLOR_RGB2BGR),
-            self.mask,
-            inpaintRadius=7,
-            flags=cv2.INPAINT_NS
-        )
-        self.processed_image = cv2.cvtColor(inpainted, cv2.COLOR_BGR2RGB)
+        mask, self.mask = self.mask, None
+        patch = inpaint_patch(self.processed_image, mask, radius=7, engine="ns")
+        if patch is not None:
+            (x0, y0, x1, y1), pixels = patch
+            self.undo_history.push(self.processed_image, (x0, y0, x1, y1), None, None)
+            self.processed_image[y0:y1, x0:x1] = pixels
         self.display_image(self.processed_image)
 
-    def push_undo_state(self):
-        if self.processed_image is not None:
-            self.undo_stack.append(self.processed_image.copy())
-            self.redo_stack.clear()
-
     def undo(self, event=None):
-        if len(self.undo_stack) > 0:
-            self.redo_stack.append(self.processed_image.copy())
-            self.processed_image = self.undo_stack.pop()
+        if self.undo_history.can_undo:
+            self.undo_history.undo(self.processed_image, None)
             self.display_image(self.processed_image)
 
     def redo(self, event=None):
-        if len(self.redo_stack) > 0:
-            self.undo_stack.append(self.processed_image.copy())
-            self.processed_image = self.redo_stack.pop()
+        if self.undo_history.can_redo:
+            self.undo_history.redo(self.processed_image, None)
             self.display_image(self.processed_image)
 
     def adjust_zoom(self, factor):
@@ -181,22 +177,32 @@ class AdvancedWatermarkRemover:
         else:
             self.adjust_zoom(0.8)
 
-    def display_image(self, image=None):
+    def display_image(self, image=None, mask=None):
         if image is None:
             return
         height, width = image.shape[:2]
-        new_width = int(width * self.zoom_level)
-        new_height = int(height * self.zoom_level)
-        img_pil = Image.fromarray(image).resize((new_width, new_height))
-        self.tk_image = ImageTk.PhotoImage(img_pil)
+        new_width = max(1, int(width * self.zoom_level))
+        new_height = max(1, int(height * self.zoom_level))
+        # Only the zoomed frame is built; a same-size photo is updated in place
+        photo = ImageBuffer(image).photo((new_width, new_height), reuse=self.tk_image, mask=mask)
         self.canvas.config(width=new_width, height=new_height)
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
+        if photo is not self.tk_image:
+            self.tk_image = photo
+            self.canvas.delete("image")
+            self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image, tags="image")
+            self.canvas.tag_lower("image")
 
     def open_image(self):
         path = filedialog.askopenfilename()
         if path:
-            self.original_image = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+            try:
+                self.original_image = ImageBuffer.load(path).pixels
+            except ValueError as e:
+                messagebox.showerror("Error", f"Failed to load image: {str(e)}")
+                return
             self.processed_image = self.original_image.copy()
+            self.mask = None
+            self.undo_history.reset(self.original_image.shape[:2])
             self.display_image(self.original_image)
             self.reset_zoom()
 
@@ -217,19 +223,15 @@ class AdvancedWatermarkRemover:
             )
             
             if path:
-                try:
-                    if path.lower().endswith(('.jpg', '.jpeg')):
-                        cv2.imwrite(path, cv2.cvtColor(self.processed_image, cv2.COLOR_RGB2BGR), 
-                                  [int(cv2.IMWRITE_JPEG_QUALITY), 95])
-                    elif path.lower().endswith('.webp'):
-                        cv2.imwrite(path, cv2.cvtColor(self.processed_image, cv2.COLOR_RGB2BGR), 
-                                  [int(cv2.IMWRITE_WEBP_QUALITY), 90])
-                    else:
-                        cv2.imwrite(path, cv2.cvtColor(self.processed_image, cv2.COLOR_RGB2BGR))
-                    
-                    messagebox.showinfo("Success", "Image saved successfully!")
-                except Exception as e:
-                    messagebox.showerror("Error", f"Failed to save image: {str(e)}")
+                # Encoded in the background from a copy, as edits change
+                # processed_image in place. JPEG is saved at quality 95,
+                # WebP at 90.
+                self.save_runner.submit(
+                    ImageBuffer(self.processed_image.copy()).save, path,
+                    on_done=lambda stats: self.update_status(
+                        f"Saved {os.path.basename(path)}: {stats[1] / 2 ** 20:.1f} MB in {stats[0]:.2f}s"),
+                    on_error=lambda e: messagebox.showerror("Error", f"Failed to save image: {str(e)}")
+                )
 
 if __name__ == "__main__":
     root = tk.Tk()